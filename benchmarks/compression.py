@@ -0,0 +1,56 @@
+"""
+    Index download with and without compressed responses on a slow link.
+
+    Downloads the full note list (data=true pages) from the stand-in, which
+    runs in its own process behind a link of limited bandwidth, asking for
+    uncompressed and then for gzipped responses.
+
+    python benchmarks/compression.py --notes 2000 --bandwidth 1024
+"""
+import optparse
+import time
+
+from standin import StandinProcess
+import simplenote
+
+
+def parse_options():
+    parser = optparse.OptionParser()
+    parser.add_option('--notes', type='int', default=2000, help='notes in the account')
+    parser.add_option('--content-size', type='int', default=2000, help='characters per note')
+    parser.add_option('--bandwidth', type='float', default=1024, help='link bandwidth in KB/s, 0 for no limit')
+    parser.add_option('--latency', type='float', default=50, help='added to every request, in ms')
+    return parser.parse_args()[0]
+
+
+def measure(accept_encoding):
+    simplenote.ACCEPT_ENCODING = accept_encoding
+    client = simplenote.Simplenote('user', 'password')
+    client.get_token()
+    started = time.time()
+    note_list, status = client.get_note_list()
+    elapsed = time.time() - started
+    assert status == 0
+    client.pool.close()
+    index = client.metrics.snapshot()['index']
+    return len(note_list), elapsed, index['bytes_in'], index['bytes_decoded']
+
+
+def main():
+    options = parse_options()
+    server = StandinProcess(latency=options.latency / 1000.0, bandwidth=options.bandwidth * 1024,
+                            note_count=options.notes, content_size=options.content_size,
+                            tag_count=20, tags_per_note=3)
+    server.point_client()
+    print('%d notes of %d characters, %.0f KB/s link, %.0f ms latency' % (
+        options.notes, options.content_size, options.bandwidth, options.latency))
+    print('%-16s %8s %10s %14s %14s' % ('accept-encoding', 'notes', 'seconds', 'KB received', 'KB decoded'))
+    for accept_encoding in (None, 'gzip, deflate'):
+        notes, elapsed, received, decoded = measure(accept_encoding)
+        print('%-16s %8d %10.2f %14.1f %14.1f' % (accept_encoding or 'none', notes, elapsed,
+                                                  received / 1024.0, decoded / 1024.0))
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
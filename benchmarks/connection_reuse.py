@@ -0,0 +1,70 @@
+"""
+    Handshakes per sync with and without the connection pool.
+
+    Runs an index download plus the content download of every note (three at
+    a time, as MultipleNoteContentDownloader does) against the local HTTPS
+    stand-in and counts the connections the server had to accept.
+
+    Usage: python benchmarks/connection_reuse.py [note_count]
+"""
+import sys
+import time
+from threading import Semaphore, Thread
+
+from standin import StandinServer, make_account, make_tls_contexts
+import simplenote
+if sys.version_info > (3, 0):
+    import urllib.request as urllib2
+else:
+    import urllib2
+
+
+def sync(client, semaphore):
+    note_list, status = client.get_note_list()
+    assert status == 0
+
+    def download(key):
+        with semaphore:
+            note, status = client.get_note(key)
+            assert status == 0
+
+    threads = [Thread(target=download, args=(note['key'],)) for note in note_list]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(note_list)
+
+
+def measure(server, client_context, pool_size, syncs=3):
+    client = simplenote.Simplenote('user', 'password', pool_size, client_context)
+    server.reset_counters()
+    started = time.time()
+    for i in range(syncs):
+        sync(client, Semaphore(3))
+    elapsed = time.time() - started
+    client.pool.close()
+    return server.connections / float(syncs), server.requests / float(syncs), elapsed / syncs
+
+
+def main():
+    note_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    server_context, client_context = make_tls_contexts()
+    if server_context is None:
+        print('openssl not available, falling back to plain HTTP (TCP handshakes only)')
+    else:
+        # Unpooled requests go through urlopen, make it trust the stand-in
+        urllib2.install_opener(urllib2.build_opener(urllib2.HTTPSHandler(context=client_context)))
+    server = StandinServer(make_account(note_count), server_context).start()
+    server.point_client()
+
+    print('%d notes, averages per sync' % note_count)
+    print('%-12s %12s %10s %10s' % ('pool size', 'handshakes', 'requests', 'seconds'))
+    for pool_size in (0, simplenote.CONNECTION_POOL_SIZE):
+        handshakes, requests, seconds = measure(server, client_context, pool_size)
+        print('%-12s %12.1f %10.1f %10.3f' % (pool_size, handshakes, requests, seconds))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
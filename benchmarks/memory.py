@@ -0,0 +1,84 @@
+"""
+    Resident memory of the plugin once its note cache is loaded.
+
+    Fills a note cache by merging a full index, then loads the plugin in a
+    fresh process with that cache (as Sublime does at startup) and reports
+    its resident memory, also after opening some notes.
+
+    Runs the plugin code headlessly, so it needs Python 2 like Sublime Text 2:
+    python2 benchmarks/memory.py --notes 10000
+"""
+import sys
+import gc
+import optparse
+import shutil
+import subprocess
+import tempfile
+
+import sublime_stub
+
+
+def resident_memory_mb():
+    # Current, not peak, resident memory (Linux)
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.0
+
+
+class Window(object):
+
+    def open_file(self, filepath):
+        return None
+
+
+def parse_options():
+    parser = optparse.OptionParser()
+    parser.add_option('--notes', type='int', default=10000, help='notes in the account')
+    parser.add_option('--content-size', type='int', default=2000, help='characters per note')
+    parser.add_option('--open', type='int', default=20, help='notes opened after loading')
+    parser.add_option('--packages-path', help=optparse.SUPPRESS_HELP)
+    return parser.parse_args()[0]
+
+
+def fill_cache(options, packages_path):
+    sublime = sublime_stub.install({'sync_every': 0}, packages_path)
+    import quick_simplenote
+    sublime.scheduler.run_until(lambda: quick_simplenote.loaded)
+    from merge_lookup import index_for
+    from standin import make_account
+    index = index_for(make_account(options.notes, options.content_size, tag_count=20, tags_per_note=3))
+    quick_simplenote.StartQuickSimplenoteSyncCommand().merge_delta((index, 'cv', True), quick_simplenote.notes)
+    quick_simplenote.save_search_index()
+
+
+def measure(options):
+    gc.collect()
+    before = resident_memory_mb()
+    sublime = sublime_stub.install({'sync_every': 0}, options.packages_path)
+    import quick_simplenote
+    sublime.scheduler.run_until(lambda: quick_simplenote.loaded)
+    gc.collect()
+    loaded = resident_memory_mb()
+    for note in quick_simplenote.notes[:options.open]:
+        quick_simplenote.open_note(note, window=Window())
+    gc.collect()
+    print('%-8d %14.1f %14.1f %20.1f' % (len(quick_simplenote.notes), before, loaded, resident_memory_mb()))
+
+
+def main():
+    options = parse_options()
+    if options.packages_path:
+        return measure(options)
+    packages_path = tempfile.mkdtemp()
+    try:
+        fill_cache(options, packages_path)
+        print('%-8s %14s %14s %20s' % ('notes', 'start MB', 'loaded MB', 'opened %d MB' % options.open))
+        subprocess.check_call([sys.executable, __file__, '--packages-path', packages_path,
+                               '--open', str(options.open)])
+    finally:
+        shutil.rmtree(packages_path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+    Note store scaling: merge and lookup times against the number of notes.
+
+    Merges a full index into an empty cache (cold) and into an up to date
+    cache (warm), then resolves every note file path the way on_modified
+    does. Per note times should stay flat as the account grows.
+
+    Runs the plugin code headlessly, so it needs Python 2 like Sublime Text 2:
+    python2 benchmarks/merge_lookup.py [note_count ...]
+"""
+import sys
+import copy
+import time
+from os import path
+
+import sublime_stub
+sublime = sublime_stub.install({'sync_every': 0})
+
+import simplenote
+from simplenote import Note
+import quick_simplenote
+from note_store import NoteStore
+from standin import make_account
+
+sublime.scheduler.run_until(lambda: quick_simplenote.loaded)
+
+
+def index_for(account):
+    return [Note.from_wire(key, note['v'], copy.deepcopy(note['d'])) for key, note in account.items()]
+
+
+def timed(function, *args):
+    started = time.time()
+    function(*args)
+    return time.time() - started
+
+
+def measure(note_count):
+    index = index_for(make_account(note_count))
+    command = quick_simplenote.StartQuickSimplenoteSyncCommand()
+    store = NoteStore()
+    quick_simplenote.notes = store
+
+    cold = timed(command.merge_delta, (copy.deepcopy(index), 'cv', True), store)
+    store = quick_simplenote.notes
+    warm = timed(command.merge_delta, (copy.deepcopy(index), 'cv', True), store)
+
+    paths = [path.join(quick_simplenote.temp_path, note['filename']) for note in store]
+    lookup = timed(lambda: [quick_simplenote.get_note_from_path(note_path) for note_path in paths])
+    return cold / note_count, warm / note_count, lookup / note_count
+
+
+def main():
+    counts = [int(count) for count in sys.argv[1:]] or [1000, 5000, 10000]
+    print('%-8s %18s %18s %18s' % ('notes', 'cold merge us/note', 'warm merge us/note', 'lookup us/note'))
+    for note_count in counts:
+        cold, warm, lookup = measure(note_count)
+        print('%-8d %18.1f %18.1f %18.1f' % (note_count, cold * 1e6, warm * 1e6, lookup * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+    Interval polling against long polling (push_sync): how long a change made
+    on the server takes to show up, and how many requests an idle account
+    costs.
+
+    Each mode runs the plugin headlessly in a fresh process against the
+    stand-in: after the first sync, notes are edited on the server at random
+    moments, then nothing happens for a while. "push, not held" is a server
+    answering long polls right away, where the plugin falls back to polling.
+
+    Runs the plugin code headlessly, so it needs Python 2 like Sublime Text 2:
+    python2 benchmarks/push.py --sync-every 10 --idle 60
+"""
+import sys
+import optparse
+import random
+import subprocess
+import tempfile
+import time
+
+import sublime_stub
+from standin import StandinProcess
+
+MODES = [('interval', False, 30), ('push', True, 30), ('push, not held', True, 0)]
+
+
+def parse_options():
+    parser = optparse.OptionParser()
+    parser.add_option('--notes', type='int', default=500, help='notes in the account')
+    parser.add_option('--sync-every', type='int', default=10, help='sync_every setting, in seconds')
+    parser.add_option('--edits', type='int', default=5, help='notes edited on the server')
+    parser.add_option('--idle', type='float', default=60, help='seconds without changes')
+    parser.add_option('--latency', type='float', default=20, help='added to every request, in ms')
+    parser.add_option('--mode', type='int', help=optparse.SUPPRESS_HELP)
+    return parser.parse_args()[0]
+
+
+def measure(options):
+    name, push_sync, hold = MODES[options.mode]
+    server = StandinProcess(latency=options.latency / 1000.0, long_poll_hold=hold,
+                            note_count=options.notes, content_size=200)
+    server.point_client()
+    settings = {'username': 'user', 'password': 'password', 'autostart': False,
+                'sync_every': options.sync_every, 'push_sync': push_sync}
+    sublime = sublime_stub.install(settings, tempfile.mkdtemp())
+    import quick_simplenote
+    # The stub doesn't run commands, syncs have to
+    def run_command(name, args=None):
+        if name == 'start_quick_simplenote_sync':
+            quick_simplenote.StartQuickSimplenoteSyncCommand().run()
+    sublime.run_command = run_command
+    run_until = sublime.scheduler.run_until
+    run_until(lambda: quick_simplenote.loaded)
+    quick_simplenote.start()
+    manager = quick_simplenote.OperationManager.instance()
+    run_until(lambda: quick_simplenote.note_cursor and not manager.is_running(), timeout=600)
+    # Let the listener start, or give up on the server
+    run_until(lambda: False, timeout=2)
+
+    generator = random.Random(0)
+    delays = []
+    for i in range(options.edits):
+        run_until(lambda: False, timeout=generator.uniform(0, options.sync_every))
+        key = server.touch(1)[0]
+        note = quick_simplenote.notes.get(key)
+        version = note.synced_version
+        edited = time.time()
+        if not run_until(lambda: note.synced_version > version and not manager.is_running(), timeout=600):
+            raise RuntimeError('Change did not arrive')
+        delays.append(time.time() - edited)
+
+    server.reset()
+    run_until(lambda: False, timeout=options.idle)
+    requests = server.stats()['requests']
+    print('%-16s %14.2f %13.2f %16d' % (name, sum(delays) / len(delays), max(delays), requests))
+    server.stop()
+
+
+def main():
+    options = parse_options()
+    if options.mode is not None:
+        return measure(options)
+    print('%d notes, sync_every %ds, %.0f ms latency, %d edits, %.0fs idle' % (
+        options.notes, options.sync_every, options.latency, options.edits, options.idle))
+    print('%-16s %14s %13s %16s' % ('mode', 'change mean s', 'change max s', 'idle requests'))
+    for mode in range(len(MODES)):
+        subprocess.check_call([sys.executable, __file__, '--mode', str(mode)] + sys.argv[1:])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+    Search index: build, query and reload times against the number of notes.
+
+    Queries mix rare words (a note number), common ones (every stand-in note
+    shares a small vocabulary, the worst case for the index) and prefixes as
+    they look while typing.
+
+    python benchmarks/search.py [note_count ...]
+"""
+import sys
+import os
+import shutil
+import tempfile
+import time
+
+import standin
+from search_index import SearchIndex
+
+QUERIES = ['title 42', 'remember', 'sublime sync', 'meet', 'to', 'draft pl', '9999', 'nothing here']
+
+
+def notes_for(account):
+    note_list = []
+    for key, note in account.items():
+        note_list.append({'key': key, 'synced_version': note['v'],
+                          'content': note['d']['content'], 'tags': note['d']['tags']})
+    return note_list
+
+
+def measure(note_count):
+    note_list = notes_for(standin.make_account(note_count, tag_count=20, tags_per_note=3))
+    index = SearchIndex()
+    started = time.time()
+    index.sync(note_list, lambda note: note['content'])
+    build = time.time() - started
+
+    query_times = []
+    for query in QUERIES:
+        for end in range(1, len(query) + 1):
+            started = time.time()
+            index.search(query[:end])
+            query_times.append(time.time() - started)
+
+    directory = tempfile.mkdtemp()
+    try:
+        filepath = os.path.join(directory, 'search_index')
+        index.save(filepath)
+        size = os.path.getsize(filepath)
+        started = time.time()
+        index = SearchIndex.load(filepath)
+        index.sync(note_list, lambda note: note['content'])
+        reload_time = time.time() - started
+    finally:
+        shutil.rmtree(directory)
+    return build, sum(query_times) / len(query_times), max(query_times), reload_time, size
+
+
+def main():
+    counts = [int(count) for count in sys.argv[1:]] or [1000, 10000]
+    print('%-8s %10s %14s %13s %10s %10s' % ('notes', 'build ms', 'query mean ms', 'query max ms', 'reload ms', 'size KB'))
+    for note_count in counts:
+        build, mean, worst, reload_time, size = measure(note_count)
+        print('%-8d %10.0f %14.2f %13.2f %10.0f %10d' % (note_count, build * 1000, mean * 1000, worst * 1000,
+                                                       reload_time * 1000, size / 1024))
+
+
+if __name__ == '__main__':
+    main()
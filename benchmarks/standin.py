@@ -0,0 +1,434 @@
+"""
+    standin.py
+    ~~~~~~~~~~
+
+    Local stand-in for the Simperium endpoints used by simplenote.py, so the
+    client can be measured without a real Simplenote account.
+
+    Serves auth, /index, /i/<id> (GET and POST) and /changes, with optional
+    artificial latency and throttling (429 with Retry-After). Control endpoints under /_standin/ give the request
+    and byte counters and let a benchmark change notes or revoke tokens on the
+    server side.
+    Responses are gzipped for clients that accept it and can go through a
+    link of limited bandwidth, shared by all connections. /changes with
+    wait=1 is held until there are changes, up to `long_poll_hold` seconds.
+"""
+import sys
+import os
+import json
+import random
+import ssl
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from multiprocessing import Process, Queue
+if sys.version_info > (3, 0):
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+    import urllib.request as urllib2
+else:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    import urllib2
+
+PACKAGE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PACKAGE_PATH not in sys.path:
+    sys.path.insert(0, PACKAGE_PATH)
+
+import simplenote
+
+TOKEN = 'standin-token'
+# Smaller bodies aren't worth compressing
+COMPRESS_MIN_SIZE = 1024
+# Bytes written at a time through a limited link
+LINK_CHUNK_SIZE = 16 * 1024
+WORDS = ('note', 'simple', 'sublime', 'text', 'sync', 'list', 'todo', 'idea',
+         'meeting', 'draft', 'plan', 'remember', 'buy', 'call', 'write', 'read')
+
+
+def make_account(note_count, content_size=200, tag_count=0, tags_per_note=0, seed=0):
+    """ Builds the notes of a stand-in account, keyed by note id
+
+        Contents are about `content_size` characters of words. Each note gets
+        up to `tags_per_note` tags out of `tag_count`, picked with a skewed
+        (1/rank) distribution so a few tags are much more common, like in
+        real accounts.
+    """
+    generator = random.Random(seed)
+    tags = ['tag%d' % i for i in range(tag_count)]
+    weights = [1.0 / (rank + 1) for rank in range(tag_count)]
+    notes = {}
+    now = time.time()
+    for i in range(note_count):
+        words = []
+        length = 0
+        while length < content_size:
+            word = generator.choice(WORDS)
+            words.append(word)
+            length += len(word) + 1
+        note_tags = set()
+        for j in range(generator.randint(0, tags_per_note) if tags else 0):
+            note_tags.add(pick_weighted(generator, tags, weights))
+        notes[uuid.UUID(int=generator.getrandbits(128)).hex] = {
+            'v': 1,
+            'd': {
+                'content': 'Title %d\n%s' % (i, ' '.join(words)[:content_size]),
+                'tags': sorted(note_tags),
+                'systemTags': [],
+                'creationDate': now - i,
+                'modificationDate': now - i,
+                'deleted': False,
+                'shareURL': '',
+                'publishURL': '',
+            }
+        }
+    return notes
+
+
+def pick_weighted(generator, items, weights):
+    point = generator.random() * sum(weights)
+    for item, weight in zip(items, weights):
+        point -= weight
+        if point <= 0:
+            return item
+    return items[-1]
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200, headers={}):
+        body = json.dumps(payload).encode('utf-8')
+        accepted = self.headers.get('Accept-Encoding') or ''
+        compress = self.server.compression and len(body) >= COMPRESS_MIN_SIZE and 'gzip' in accepted
+        if compress:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if compress:
+            self.send_header('Content-Encoding', 'gzip')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.server.bandwidth and self.counted:
+            for start in range(0, len(body), LINK_CHUNK_SIZE):
+                chunk = body[start:start + LINK_CHUNK_SIZE]
+                self.server.wait_for_link(len(chunk))
+                self.wfile.write(chunk)
+        else:
+            self.wfile.write(body)
+        if self.counted:
+            self.server.count_bytes(0, len(body))
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if self.counted:
+            self.server.count_bytes(len(body), 0)
+        return body
+
+    def authorized(self):
+        return self.headers.get('X-Simperium-Token') == self.server.token
+
+    def route(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+        # Control requests stay out of the counters
+        self.counted = parts[0] != '_standin'
+        if self.counted:
+            self.server.count_request()
+            if self.server.latency:
+                time.sleep(self.server.latency)
+        return parts, query
+
+    def do_POST(self):
+        parts, query = self.route()
+        body = self.read_body()
+        if parts[-1] == 'authorize':
+            self.send_json({'access_token': self.server.token})
+        elif not self.authorized():
+            self.send_json({}, 401)
+        elif len(parts) >= 5 and parts[2] == simplenote.BUCKET and parts[3] == 'i':
+            note = self.server.put_note(parts[4], json.loads(body.decode('utf-8')))
+            if note is None:
+                # Nothing would change
+                self.send_json({}, 412)
+            else:
+                self.send_json(note['d'], headers={'X-Simperium-Version': str(note['v'])})
+        else:
+            self.send_json({}, 404)
+
+    def do_GET(self):
+        parts, query = self.route()
+        if parts[0] == '_standin':
+            return self.control(parts[1], query)
+        if not self.authorized():
+            return self.send_json({}, 401)
+        if self.server.should_throttle():
+            return self.send_json({}, 429, headers={'Retry-After': '0'})
+        if len(parts) < 4 or parts[2] != simplenote.BUCKET:
+            return self.send_json({}, 404)
+        notes = self.server.notes
+        endpoint = parts[3:]
+        if endpoint == ['index']:
+            with self.server.lock:
+                keys = sorted(notes.keys())
+                limit = int(query.get('limit', [simplenote.NOTE_FETCH_LENGTH])[0])
+                start = int(query.get('mark', [0])[-1])
+                page = keys[start:start + limit]
+                payload = {'index': [{'id': key, 'v': notes[key]['v'], 'd': notes[key]['d']} for key in page],
+                           'current': self.server.current}
+            if start + limit < len(keys):
+                payload['mark'] = str(start + limit)
+            self.send_json(payload)
+        elif endpoint == ['changes']:
+            changes = self.server.changes_since(query.get('cv', [''])[0],
+                                                int(query.get('limit', [simplenote.NOTE_FETCH_LENGTH])[0]),
+                                                query.get('wait', ['0'])[0] == '1')
+            if changes is None:
+                self.send_json({}, 404)
+            else:
+                self.send_json(changes)
+        elif len(endpoint) == 2 and endpoint[0] == 'i' and endpoint[1] in notes:
+            note = notes[endpoint[1]]
+            self.send_json(note['d'], headers={'X-Simperium-Version': str(note['v'])})
+        else:
+            self.send_json({}, 404)
+
+    def control(self, command, query):
+        if command == 'stats':
+            self.send_json(self.server.stats())
+        elif command == 'reset':
+            self.server.reset_counters()
+            self.send_json({})
+        elif command == 'revoke':
+            # Tokens given so far stop working
+            self.server.token = uuid.uuid4().hex
+            self.send_json({})
+        elif command == 'touch':
+            self.send_json(self.server.touch_notes(int(query.get('count', [1])[0])))
+        else:
+            self.send_json({}, 404)
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    """ Threaded stand-in server, counts accepted connections (one TCP and,
+        with TLS, one TLS handshake each), requests and body bytes
+    """
+    daemon_threads = True
+
+    def __init__(self, notes, ssl_context=None, latency=0, port=0, throttle_rate=0, bandwidth=0, compression=True,
+                 long_poll_hold=30):
+        HTTPServer.__init__(self, ('127.0.0.1', port), StandinHandler)
+        self.notes = notes
+        self.ssl_context = ssl_context
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        # In bytes per second, 0 for no limit
+        self.bandwidth = bandwidth
+        self.compression = compression
+        self.link_free_at = 0
+        self.token = TOKEN
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+        # Notified on every change, for the long polls
+        self.changed = threading.Condition(self.lock)
+        # 0 answers long polls right away, like a server not supporting them
+        self.long_poll_hold = long_poll_hold
+        # Change log as (cv, note id), newest last. Starts with the
+        # cursor handed out by the index before any change
+        self.current = uuid.uuid4().hex
+        self.changes = [(self.current, None)]
+        self.reset_counters()
+
+    def get_request(self):
+        sock, address = HTTPServer.get_request(self)
+        with self.lock:
+            self.connections += 1
+        if self.ssl_context is not None:
+            sock = self.ssl_context.wrap_socket(sock, server_side=True)
+        return sock, address
+
+    def handle_error(self, request, client_address):
+        # Clients dropping idle keep-alive connections is expected
+        pass
+
+    def should_throttle(self):
+        with self.lock:
+            return self.random.random() < self.throttle_rate
+
+    def wait_for_link(self, size):
+        # Responses take turns on the link, each chunk waits for the
+        # ones queued before it to go through
+        with self.lock:
+            start = max(time.time(), self.link_free_at)
+            self.link_free_at = start + size / float(self.bandwidth)
+            done = self.link_free_at
+        time.sleep(max(0, done - time.time()))
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def count_bytes(self, received, sent):
+        with self.lock:
+            self.bytes_received += received
+            self.bytes_sent += sent
+
+    def reset_counters(self):
+        with self.lock:
+            self.connections = 0
+            self.requests = 0
+            self.bytes_received = 0
+            self.bytes_sent = 0
+
+    def stats(self):
+        with self.lock:
+            return {'connections': self.connections, 'requests': self.requests,
+                    'bytes_received': self.bytes_received, 'bytes_sent': self.bytes_sent}
+
+    def put_note(self, key, data):
+        with self.lock:
+            note = self.notes.setdefault(key, {'v': 0, 'd': {}})
+            changed = [name for name, value in data.items()
+                       if name != 'modificationDate' and note['d'].get(name) != value]
+            if note['v'] and not changed:
+                return None
+            note['d'].update(data)
+            note['v'] += 1
+            self.record_change(key)
+            return note
+
+    def touch_notes(self, count):
+        """ Edits `count` notes as another client would """
+        with self.lock:
+            keys = sorted(self.notes.keys())[:count]
+            for key in keys:
+                note = self.notes[key]
+                note['d']['content'] += '\nedited elsewhere'
+                note['d']['modificationDate'] = time.time()
+                note['v'] += 1
+                self.record_change(key)
+            return keys
+
+    def record_change(self, key):
+        self.current = uuid.uuid4().hex
+        self.changes.append((self.current, key))
+        self.changed.notify_all()
+
+    def changes_since(self, cv, limit, wait=False):
+        with self.lock:
+            positions = [i for i, change in enumerate(self.changes) if change[0] == cv]
+            if not positions:
+                return None
+            start = positions[0] + 1
+            deadline = time.time() + self.long_poll_hold
+            while wait and start >= len(self.changes) and time.time() < deadline:
+                self.changed.wait(deadline - time.time())
+            changes = []
+            for change_cv, key in self.changes[start:start + limit]:
+                note = self.notes[key]
+                changes.append({'id': key, 'o': 'M', 'cv': change_cv, 'ev': note['v'], 'd': note['d']})
+            return changes
+
+    @property
+    def base_url(self):
+        scheme = 'https' if self.ssl_context is not None else 'http'
+        return '%s://127.0.0.1:%d' % (scheme, self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def point_client(self):
+        """ Makes simplenote.py talk to this server """
+        point_client(self.base_url)
+
+
+def point_client(base_url):
+    simplenote.AUTH_URL = '%s/1/%s/authorize/' % (base_url, simplenote.APP_ID)
+    simplenote.DATA_URL = '%s/1/%s/%s' % (base_url, simplenote.APP_ID, simplenote.BUCKET)
+
+
+def serve(ready, account_options, server_options):
+    server = StandinServer(make_account(**account_options), **server_options)
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+class StandinProcess(object):
+    """ Runs a StandinServer in a child process, so it doesn't take part
+        in the memory and CPU measured in the benchmark process
+    """
+
+    def __init__(self, latency=0, throttle_rate=0, bandwidth=0, compression=True, long_poll_hold=30,
+                 **account_options):
+        ready = Queue()
+        server_options = {'latency': latency, 'throttle_rate': throttle_rate, 'bandwidth': bandwidth,
+                          'compression': compression, 'long_poll_hold': long_poll_hold}
+        self.process = Process(target=serve, args=(ready, account_options, server_options))
+        self.process.daemon = True
+        self.process.start()
+        self.base_url = 'http://127.0.0.1:%d' % ready.get(timeout=120)
+
+    def point_client(self):
+        point_client(self.base_url)
+
+    def control(self, command, **params):
+        query = '&'.join('%s=%s' % item for item in params.items())
+        response = urllib2.urlopen('%s/_standin/%s?%s' % (self.base_url, command, query))
+        return json.loads(response.read().decode('utf-8'))
+
+    def stats(self):
+        return self.control('stats')
+
+    def reset(self):
+        return self.control('reset')
+
+    def touch(self, count):
+        return self.control('touch', count=count)
+
+    def revoke(self):
+        return self.control('revoke')
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+
+def make_tls_contexts():
+    """ Creates a throwaway self-signed certificate with openssl and returns
+        (server_context, client_context), or (None, None) if it can't
+    """
+    directory = tempfile.mkdtemp()
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                                   '-keyout', key, '-out', cert, '-days', '1',
+                                   '-subj', '/CN=127.0.0.1'], stdout=devnull, stderr=devnull)
+        server_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        server_context.load_cert_chain(cert, key)
+        client_context = ssl.create_default_context(cafile=cert)
+        client_context.check_hostname = False
+        return server_context, client_context
+    except (OSError, subprocess.CalledProcessError, AttributeError):
+        return None, None
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,68 @@
+"""
+    Cold start: how long loading the plugin blocks, and how long until its
+    note cache is ready.
+
+    Fills a note cache (and temp files for some notes, plus stale ones to
+    clean up), then loads the plugin in a fresh process as Sublime does at
+    startup.
+
+    Runs the plugin code headlessly, so it needs Python 2 like Sublime Text 2:
+    python2 benchmarks/startup.py --notes 10000
+"""
+import sys
+import optparse
+import shutil
+import subprocess
+import tempfile
+import time
+from os import path
+
+import sublime_stub
+from memory import fill_cache
+
+
+def parse_options():
+    parser = optparse.OptionParser()
+    parser.add_option('--notes', type='int', default=10000, help='notes in the account')
+    parser.add_option('--content-size', type='int', default=2000, help='characters per note')
+    parser.add_option('--open-files', type='int', default=1000, help='temp files of notes')
+    parser.add_option('--stale-files', type='int', default=1000, help='temp files of deleted notes')
+    parser.add_option('--packages-path', help=optparse.SUPPRESS_HELP)
+    return parser.parse_args()[0]
+
+
+def add_temp_files(options, packages_path):
+    import quick_simplenote
+    for note in quick_simplenote.notes[:options.open_files]:
+        quick_simplenote.write_note_to_path(note, quick_simplenote.get_path_for_note(note))
+    for i in range(options.stale_files):
+        open(path.join(quick_simplenote.temp_path, 'Deleted %d (key%d)' % (i, i)), 'w').close()
+
+
+def measure(options):
+    started = time.time()
+    sublime = sublime_stub.install({'sync_every': 0}, options.packages_path)
+    import quick_simplenote
+    imported = time.time() - started
+    sublime.scheduler.run_until(lambda: getattr(quick_simplenote, 'loaded', True), timeout=600)
+    ready = time.time() - started
+    print('%-8d %12.0f %12.0f' % (len(quick_simplenote.notes), imported * 1000, ready * 1000))
+
+
+def main():
+    options = parse_options()
+    if options.packages_path:
+        return measure(options)
+    packages_path = tempfile.mkdtemp()
+    try:
+        options.open = 0
+        fill_cache(options, packages_path)
+        add_temp_files(options, packages_path)
+        print('%-8s %12s %12s' % ('notes', 'import ms', 'ready ms'))
+        subprocess.check_call([sys.executable, __file__, '--packages-path', packages_path])
+    finally:
+        shutil.rmtree(packages_path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+    sublime_stub.py
+    ~~~~~~~~~~~~~~~
+
+    Headless stand-ins for the `sublime` and `sublime_plugin` modules so the
+    plugin can be imported and driven outside of Sublime Text.
+"""
+import sys
+import os
+import heapq
+import itertools
+import threading
+import time
+import types
+import tempfile
+
+PACKAGE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Settings(object):
+
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+        self.callbacks = {}
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def set(self, name, value):
+        self.values[name] = value
+        for callback in list(self.callbacks.values()):
+            callback()
+
+    def add_on_change(self, key, callback):
+        self.callbacks[key] = callback
+
+    def clear_on_change(self, key):
+        self.callbacks.pop(key, None)
+
+
+class Scheduler(object):
+    """ Runs set_timeout callbacks on the calling thread, in due order.
+        Like in Sublime, set_timeout can be called from any thread
+    """
+
+    def __init__(self):
+        self.queue = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def set_timeout(self, callback, delay):
+        with self.lock:
+            heapq.heappush(self.queue, (time.time() + delay / 1000.0, next(self.counter), callback))
+
+    def run_until(self, condition, timeout=60):
+        """ Runs callbacks until `condition()` is true, sleeping to honor
+            the delays. Returns False on timeout
+        """
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                return False
+            if not self.queue:
+                time.sleep(0.001)
+                continue
+            with self.lock:
+                due, count, callback = self.queue[0]
+                wait = due - time.time()
+                if wait <= 0:
+                    heapq.heappop(self.queue)
+            if wait > 0:
+                time.sleep(min(wait, 0.01))
+                continue
+            callback()
+        return True
+
+
+def install(settings=None, packages_path=None):
+    """ Registers the stub modules and returns the `sublime` one """
+    if packages_path is None:
+        packages_path = tempfile.mkdtemp()
+    scheduler = Scheduler()
+    settings_object = Settings(settings)
+
+    sublime = types.ModuleType('sublime')
+    sublime.scheduler = scheduler
+    sublime.settings = settings_object
+    sublime.packages_path = lambda: packages_path
+    sublime.load_settings = lambda name: settings_object
+    sublime.set_timeout = scheduler.set_timeout
+    sublime.windows = lambda: []
+    sublime.active_window = lambda: None
+    sublime.ok_cancel_dialog = lambda message, ok_title='': True
+    sublime.status_message = lambda message: None
+    sublime.run_command = lambda name, args=None: None
+
+    sublime_plugin = types.ModuleType('sublime_plugin')
+    for name in ('EventListener', 'ApplicationCommand', 'WindowCommand', 'TextCommand'):
+        setattr(sublime_plugin, name, type(name, (object,), {}))
+
+    sys.modules['sublime'] = sublime
+    sys.modules['sublime_plugin'] = sublime_plugin
+    if PACKAGE_PATH not in sys.path:
+        sys.path.insert(0, PACKAGE_PATH)
+    return sublime
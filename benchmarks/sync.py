@@ -0,0 +1,99 @@
+"""
+    Cold and warm sync of the plugin against the local Simperium stand-in.
+
+    Runs StartQuickSimplenoteSyncCommand and the operations it queues
+    headlessly (stubbed sublime module), first with an empty cache (cold),
+    then again after some notes were edited on the server (warm), and
+    reports time, requests, bytes transferred and peak memory.
+
+    The plugin code needs Python 2, like Sublime Text 2:
+    python2 benchmarks/sync.py --notes 5000 --latency 50
+"""
+import sys
+import gc
+import optparse
+import resource
+import time
+
+import sublime_stub
+from standin import StandinProcess
+
+
+def peak_memory_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+def parse_options():
+    parser = optparse.OptionParser()
+    parser.add_option('--notes', type='int', default=2000, help='notes in the account')
+    parser.add_option('--content-size', type='int', default=500, help='characters per note')
+    parser.add_option('--tags', type='int', default=20, help='distinct tags in the account')
+    parser.add_option('--tags-per-note', type='int', default=3, help='maximum tags per note')
+    parser.add_option('--latency', type='float', default=0, help='added to every request, in ms')
+    parser.add_option('--throttle-rate', type='float', default=0, help='fraction of reads answered with 429')
+    parser.add_option('--changes', type='int', default=10, help='notes edited before the warm sync')
+    parser.add_option('--pool-size', type='int', default=None, help='connection_pool_size setting')
+    return parser.parse_args()[0]
+
+
+def run_sync(quick_simplenote, sublime, server):
+    server.reset()
+    manager = quick_simplenote.OperationManager.instance()
+    # Time until the first note content is merged
+    first_note = []
+    update_note = quick_simplenote.update_note
+    def timed_update_note(existing_note, updated_note):
+        if not first_note:
+            first_note.append(time.time())
+        update_note(existing_note, updated_note)
+    quick_simplenote.update_note = timed_update_note
+    started = time.time()
+    try:
+        quick_simplenote.StartQuickSimplenoteSyncCommand().run()
+        if not sublime.scheduler.run_until(lambda: not manager.is_running(), timeout=3600):
+            raise RuntimeError('Sync did not finish')
+    finally:
+        quick_simplenote.update_note = update_note
+    elapsed = time.time() - started
+    first_note = first_note[0] - started if first_note else 0
+    return elapsed, first_note, server.stats(), peak_memory_mb()
+
+
+def main():
+    options = parse_options()
+    server = StandinProcess(latency=options.latency / 1000.0, throttle_rate=options.throttle_rate,
+                            note_count=options.notes,
+                            content_size=options.content_size, tag_count=options.tags,
+                            tags_per_note=options.tags_per_note)
+    server.point_client()
+
+    settings = {'username': 'user', 'password': 'password', 'autostart': False, 'sync_every': 0}
+    if options.pool_size is not None:
+        settings['connection_pool_size'] = options.pool_size
+    sublime = sublime_stub.install(settings)
+    import quick_simplenote
+    sublime.scheduler.run_until(lambda: quick_simplenote.loaded)
+    gc.collect()
+    baseline_memory = peak_memory_mb()
+    quick_simplenote.start()
+
+    print('%d notes of %d characters, %d tags, %.0f ms latency' % (
+        options.notes, options.content_size, options.tags, options.latency))
+    print('%-6s %10s %14s %10s %14s %14s %14s' % ('sync', 'seconds', 'first note s', 'requests', 'KB received',
+                                                 'KB sent', 'peak MB'))
+    results = [('cold',) + run_sync(quick_simplenote, sublime, server)]
+    server.touch(options.changes)
+    results.append(('warm',) + run_sync(quick_simplenote, sublime, server))
+    for name, elapsed, first_note, stats, memory in results:
+        print('%-6s %10.3f %14.3f %10d %14.1f %14.1f %14.1f' % (
+            name, elapsed, first_note, stats['requests'], stats['bytes_sent'] / 1024.0,
+            stats['bytes_received'] / 1024.0, memory))
+    print('baseline memory before syncing: %.1f MB' % baseline_memory)
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+import pickle
+from os import path, remove, makedirs, listdir
+from threading import Lock
+
+from simplenote import replace_file
+
+
+class NoteStore(object):
+    """ Notes indexed by key and by filename, plus the ordered list used
+        to show them. Iterating and indexing go through the ordered list.
+    """
+
+    def __init__(self, notes=[]):
+        self._notes = []
+        self._by_key = {}
+        self._by_filename = {}
+        # Filename each key is indexed under
+        self._filenames = {}
+        for note in notes:
+            self.add(note)
+
+    def __iter__(self):
+        return iter(self._notes)
+
+    def __len__(self):
+        return len(self._notes)
+
+    def __getitem__(self, index):
+        return self._notes[index]
+
+    def __contains__(self, key):
+        return key in self._by_key
+
+    def get(self, key):
+        return self._by_key.get(key)
+
+    def get_by_filename(self, filename):
+        return self._by_filename.get(filename)
+
+    def add(self, note):
+        if note.key in self._by_key:
+            self.discard([note.key])
+        self._notes.append(note)
+        self._by_key[note.key] = note
+        self.refresh(note)
+
+    def refresh(self, note):
+        # Call after the note's filename might have changed
+        filename = getattr(note, 'filename', None)
+        old_filename = self._filenames.get(note.key)
+        if old_filename == filename:
+            return
+        if old_filename is not None and self._by_filename.get(old_filename) is note:
+            del self._by_filename[old_filename]
+        if filename:
+            self._by_filename[filename] = note
+            self._filenames[note.key] = filename
+        else:
+            self._filenames.pop(note.key, None)
+
+    def remove(self, note):
+        self.discard([note.key])
+
+    def discard(self, keys):
+        # Removes all the notes with the given keys in one pass
+        keys = set(keys)
+        removed = [self._by_key.pop(key) for key in keys if key in self._by_key]
+        if not removed:
+            return
+        self._notes = [note for note in self._notes if not note.key in keys]
+        for note in removed:
+            filename = self._filenames.pop(note.key, None)
+            if filename is not None and self._by_filename.get(filename) is note:
+                del self._by_filename[filename]
+
+    def keys(self):
+        return self._by_key.keys()
+
+    def sort(self, key=None, reverse=False):
+        self._notes.sort(key=key, reverse=reverse)
+
+    def to_list(self):
+        return list(self._notes)
+
+
+class NoteCache(object):
+    """ Append-only note log on disk. The file starts with a pickled list
+        of notes (a snapshot, which is also what older caches contain)
+        followed by ('put', note) and ('delete', keys) records, so a change
+        only appends its own notes. The log is rewritten as a single
+        snapshot once it holds more records than live notes.
+    """
+
+    COMPACT_MIN_RECORDS = 500
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.records = 0
+        self._lock = Lock()
+
+    def load(self):
+        notes = {}
+        order = []
+        self.records = 0
+        try:
+            with open(self.filepath, 'r+b') as cache_file:
+                good_offset = 0
+                while True:
+                    try:
+                        record = pickle.load(cache_file)
+                    except EOFError:
+                        break
+                    except Exception:
+                        # Torn write at the end, drop it so appends stay readable
+                        cache_file.truncate(good_offset)
+                        break
+                    good_offset = cache_file.tell()
+                    if isinstance(record, list):
+                        notes = {}
+                        order = []
+                        self.records = 0
+                        record = ('put', record)
+                    else:
+                        self.records += 1
+                        if record[0] == 'put':
+                            record = ('put', [record[1]])
+                    if record[0] == 'put':
+                        for note in record[1]:
+                            if not note['key'] in notes:
+                                order.append(note['key'])
+                            notes[note['key']] = note
+                    elif record[0] == 'delete':
+                        for key in record[1]:
+                            notes.pop(key, None)
+        except IOError:
+            pass
+        return [notes[key] for key in order if key in notes]
+
+    def write(self, notes=(), deleted_keys=()):
+        deleted_keys = list(deleted_keys)
+        with self._lock:
+            with open(self.filepath, 'ab') as cache_file:
+                for note in notes:
+                    pickle.dump(('put', note), cache_file, pickle.HIGHEST_PROTOCOL)
+                    self.records += 1
+                if deleted_keys:
+                    pickle.dump(('delete', deleted_keys), cache_file, pickle.HIGHEST_PROTOCOL)
+                    self.records += 1
+
+    def needs_compaction(self, note_count):
+        return self.records > max(self.COMPACT_MIN_RECORDS, note_count)
+
+    def compact(self, notes):
+        temp_filepath = self.filepath + '.tmp'
+        with self._lock:
+            with open(temp_filepath, 'wb') as cache_file:
+                pickle.dump(list(notes), cache_file, pickle.HIGHEST_PROTOCOL)
+            replace_file(temp_filepath, self.filepath)
+            self.records = 0
+
+
+class ContentStore(object):
+    """ Note contents on disk, one file per note key, so only the notes in
+        use need their content in memory. The most recently used contents
+        are kept in memory up to `max_size` bytes.
+    """
+
+    def __init__(self, directory, max_size=2 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = 0
+        # key -> [content, last use]
+        self._cache = {}
+        self._uses = 0
+        self._lock = Lock()
+        if not path.exists(directory):
+            makedirs(directory)
+
+    def get_path(self, key):
+        return path.join(self.directory, key)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._uses += 1
+                entry[1] = self._uses
+                return entry[0]
+        try:
+            with open(self.get_path(key), 'rb') as content_file:
+                content = content_file.read()
+        except IOError:
+            return None
+        self._remember(key, content)
+        return content
+
+    def put(self, key, content):
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        temp_filepath = self.get_path(key) + '.tmp'
+        with open(temp_filepath, 'wb') as content_file:
+            content_file.write(content)
+        replace_file(temp_filepath, self.get_path(key))
+        self._remember(key, content)
+
+    def remove(self, keys):
+        for key in keys:
+            with self._lock:
+                self._forget(key)
+            try:
+                remove(self.get_path(key))
+            except OSError:
+                pass
+
+    def keys(self):
+        return set(name for name in listdir(self.directory) if not name.endswith('.tmp'))
+
+    def _remember(self, key, content):
+        with self._lock:
+            self._forget(key)
+            if len(content) > self.max_size:
+                return
+            self._uses += 1
+            self._cache[key] = [content, self._uses]
+            self.size += len(content)
+            if self.size > self.max_size:
+                # Evict the least recently used down to 3/4 of the limit,
+                # so a full cache doesn't sort on every access
+                for old_key, entry in sorted(self._cache.items(), key=lambda item: item[1][1]):
+                    if self.size <= self.max_size * 3 / 4:
+                        break
+                    self._forget(old_key)
+
+    def _forget(self, key):
+        entry = self._cache.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
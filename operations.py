@@ -1,13 +1,27 @@
-from threading import Thread
+from threading import Thread, Lock
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
 from abc import ABCMeta, abstractmethod
 import time
 
+from simplenote import Note, backoff_delay
+
+# Priority classes, lower runs first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_OPEN = 1
+PRIORITY_BACKGROUND = 2
+
 class Operation(Thread):
+    priority = PRIORITY_BACKGROUND
 
     def __init__(self, group=None, target=None, name=None, args=(), kwargs={}, Verbose=None):
         Thread.__init__(self, group, target, name, args, kwargs, Verbose)
         self.callback = None
         self.exception_callback = None
+        self.finished_callback = None
+        self.cancelled = False
 
     def set_callback(self, callback, kwargs={}):
         self.callback = callback
@@ -16,6 +30,27 @@ class Operation(Thread):
     def set_exception_callback(self, callback):
         self.exception_callback = callback
 
+    def set_finished_callback(self, callback):
+        # Called from the operation's thread as soon as it's done
+        self.finished_callback = callback
+
+    def run(self):
+        try:
+            self.run_operation()
+        except Exception as e:
+            self.result = e
+        finally:
+            if self.finished_callback:
+                self.finished_callback(self)
+
+    def run_operation(self):
+        pass
+
+    def cancel(self):
+        # Nobody waits for the result anymore, operations
+        # can check this to stop early
+        self.cancelled = True
+
     def join(self):
         Thread.join(self)
         if self.callback:
@@ -30,6 +65,16 @@ class Operation(Thread):
     def get_result(self):
         return None
 
+    def get_keys(self):
+        # Keys of the notes this operation works on, operations
+        # sharing a key run in the order they were added
+        return set()
+
+    def coalesce_into(self, operation):
+        # Given the last waiting operation on the same notes, take it
+        # over so this one doesn't need to run. Returns True if done
+        return False
+
     def get_run_finished_text(self):
         return None
 
@@ -37,11 +82,13 @@ class Operation(Thread):
         return None
 
 class NoteCreator(Operation):
+    priority = PRIORITY_INTERACTIVE
+
     def __init__(self, group=None, target=None, name=None, args=(), kwargs={}, Verbose=None, simplenote_instance=None):
         Operation.__init__(self, group, target, name, args, kwargs, Verbose)
         self.simplenote_instance = simplenote_instance
 
-    def run(self):
+    def run_operation(self):
         print('QuickSimplenote: Creating note')
         operation_result = self.simplenote_instance.add_note('')
         if operation_result[1] == 0:
@@ -59,55 +106,91 @@ class NoteCreator(Operation):
         return self.result
 
 class NoteDownloader(Thread):
-    def __init__(self, note_id, semaphore, group=None, target=None, name=None, args=(), kwargs={}, Verbose=None, simplenote_instance=None):
+    # Worker that downloads notes from a shared queue until it's empty
+    def __init__(self, note_queue, results, group=None, target=None, name=None, args=(), kwargs={}, Verbose=None, simplenote_instance=None, stop_on_error=True):
         Thread.__init__(self, group, target, name, args, kwargs, Verbose)
-        self.note_id = note_id
-        self.semaphore = semaphore
+        self.note_queue = note_queue
+        self.results = results
         self.simplenote_instance = simplenote_instance
-    
+        self.stop_on_error = stop_on_error
+
     def run(self):
-        self.semaphore.acquire()
-        print('QuickSimplenote: Downloading %s' % self.note_id)
-        operation_result = self.simplenote_instance.get_note(self.note_id)
-        if operation_result[1] == 0:
-            self.result = operation_result[0]
-        else:
-            self.result = Exception("Error getting note")
-        self.semaphore.release()
+        while True:
+            # Once a note failed the batch is useless in all-or-nothing mode
+            if self.results.cancelled or (self.stop_on_error and self.results.errors):
+                return
+            try:
+                note_id = self.note_queue.get_nowait()
+            except Empty:
+                return
+            print('QuickSimplenote: Downloading %s' % note_id)
+            operation_result = self.simplenote_instance.get_note(note_id)
+            if operation_result[1] == 0:
+                self.results.add(note_id, operation_result[0])
+            else:
+                self.results.add(note_id, Exception("Error getting note"))
+
+class DownloadResults(object):
+    def __init__(self):
+        self.notes = {}
+        self.errors = 0
+        self.cancelled = False
+        self.lock = Lock()
+
+    def add(self, note_id, result):
+        with self.lock:
+            self.notes[note_id] = result
+            if isinstance(result, Exception):
+                self.errors += 1
 
-    def join(self):
-        Thread.join(self)
-        return self.result
-        
 class MultipleNoteContentDownloader(Operation):
 
-    def __init__(self, semaphore, group=None, target=None, name=None, args=(), kwargs={}, Verbose=None, simplenote_instance=None, notes=None):
+    def __init__(self, group=None, target=None, name=None, args=(), kwargs={}, Verbose=None, simplenote_instance=None, notes=None, workers=3, partial_results=False, priority=PRIORITY_BACKGROUND):
         Operation.__init__(self, group, target, name, args, kwargs, Verbose)
+        self.priority = priority
         self.notes = notes
-        self.semaphore = semaphore
+        self.workers = workers
+        self.partial_results = partial_results
+        self.failed = []
+        self.results = DownloadResults()
         self.simplenote_instance = simplenote_instance
 
-    def run(self):
-        threads = []
+    def cancel(self):
+        Operation.cancel(self)
+        self.results.cancelled = True
+
+    def run_operation(self):
+        note_queue = Queue()
         for current_note in self.notes:
-            new_thread = NoteDownloader(current_note['key'], self.semaphore, simplenote_instance=self.simplenote_instance)
+            note_queue.put(current_note['key'])
+        results = self.results
+
+        threads = []
+        for i in range(max(1, min(self.workers, len(self.notes)))):
+            new_thread = NoteDownloader(note_queue, results, simplenote_instance=self.simplenote_instance,
+                                        stop_on_error=not self.partial_results)
             threads.append(new_thread)
             new_thread.start()
+        for thread in threads:
+            thread.join()
 
-        operation_result = [thread.join() for thread in threads]
-
-        error = False
-        for an_object in operation_result:
-            if isinstance(an_object, Exception):
-                error = True
-        if not error:
+        operation_result = [results.notes.get(note['key']) for note in self.notes]
+        self.failed = [note['key'] for note, result in zip(self.notes, operation_result) if not isinstance(result, Note)]
+        if not self.failed:
             self.result = operation_result
+        elif self.partial_results:
+            # Failed notes keep needing an update, so they're retried on the next sync
+            print('QuickSimplenote: Error getting %d note(s)' % len(self.failed))
+            self.result = [result for result in operation_result if isinstance(result, Note)]
         else:
             self.result = Exception("Error getting note")
 
     def get_result(self):
         return self.result
 
+    def get_keys(self):
+        return set([note['key'] for note in self.notes])
+
     def get_run_finished_text(self):
         return 'QuickSimplenote: Done'
 
@@ -116,18 +199,43 @@ class MultipleNoteContentDownloader(Operation):
 
 class GetNotesDelta(Operation):
 
-    def __init__(self, group=None, target=None, name=None, args=(), kwargs={}, Verbose=None, simplenote_instance=None):
+    def __init__(self, group=None, target=None, name=None, args=(), kwargs={}, Verbose=None, simplenote_instance=None, cursor=None, page_callback=None):
         Operation.__init__(self, group, target, name, args, kwargs, Verbose)
         self.note_resume = []
         self.simplenote_instance = simplenote_instance
-
-    def run(self):
-        note_resume_operation = self.simplenote_instance.get_note_list()
-        if note_resume_operation[1] == 0:
-            note_resume = note_resume_operation[0]
-            self.result = [note for note in note_resume if note['deleted'] == 0]
-        else:
-            self.result = Exception("Error getting notes")
+        self.cursor = cursor
+        # Called from the operation's thread with each page of the full
+        # note list as it arrives, instead of keeping them for the result
+        self.page_callback = page_callback
+
+    def run_operation(self):
+        # Result is (note_resume, cursor, full_index):
+        #   full_index: the resume has every note, missing ones were deleted
+        #   otherwise: the resume has only the changes since the cursor
+        if self.cursor:
+            changes_operation = self.simplenote_instance.get_changes(self.cursor)
+            if changes_operation[1] == 0:
+                self.result = (changes_operation[0], self.simplenote_instance.current, False)
+                return
+            elif changes_operation[1] == -1:
+                self.result = Exception("Error getting changes")
+                return
+            print('QuickSimplenote: Change cursor rejected, getting full note list')
+
+        note_resume = []
+        for page, status in self.simplenote_instance.get_note_pages():
+            if status != 0:
+                self.result = Exception("Error getting notes")
+                return
+            if self.cancelled:
+                self.result = Exception("Cancelled getting notes")
+                return
+            page = [note for note in page if note['deleted'] == 0]
+            if self.page_callback:
+                self.page_callback(page)
+            else:
+                note_resume.extend(page)
+        self.result = (note_resume, self.simplenote_instance.current, True)
 
     def get_result(self):
         return self.result
@@ -138,7 +246,67 @@ class GetNotesDelta(Operation):
     def get_update_run_text(self):
         return 'QuickSimplenote: Downloading note list'
 
+class ChangeListener(Thread):
+    # Worker that long polls the changes feed, handing each batch of changes
+    # to on_changes(listener, notes, cursor) as they arrive. Once it can't go
+    # on it calls on_stopped(listener, reason), reason being 'cursor' if the
+    # cursor was rejected, 'not_held' if the server doesn't wait for changes
+    # or 'errors'. Both are called from the listener's thread
+    def __init__(self, group=None, target=None, name=None, args=(), kwargs={}, Verbose=None, simplenote_instance=None, cursor=None, on_changes=None, on_stopped=None, max_errors=3, min_wait=1):
+        Thread.__init__(self, group, target, name, args, kwargs, Verbose)
+        self.daemon = True
+        self.simplenote_instance = simplenote_instance
+        self.cursor = cursor
+        self.on_changes = on_changes
+        self.on_stopped = on_stopped
+        self.max_errors = max_errors
+        # Answers with no changes quicker than this (in seconds) mean
+        # the server didn't wait
+        self.min_wait = min_wait
+        self.stopped = False
+
+    def stop(self):
+        # Takes effect once the poll in progress returns
+        self.stopped = True
+
+    def run(self):
+        errors = 0
+        not_held = 0
+        reason = None
+        while not self.stopped:
+            started = time.time()
+            try:
+                changes, cursor, status = self.simplenote_instance.wait_for_changes(self.cursor)
+            except Exception as e:
+                changes, cursor, status = e, self.cursor, -1
+            if self.stopped:
+                return
+            if status == -2:
+                reason = 'cursor'
+                break
+            elif status != 0:
+                errors += 1
+                if errors >= self.max_errors:
+                    reason = 'errors'
+                    break
+                time.sleep(backoff_delay(errors))
+            elif changes:
+                errors = not_held = 0
+                self.cursor = cursor
+                self.on_changes(self, changes, cursor)
+            elif time.time() - started < self.min_wait:
+                not_held += 1
+                if not_held >= self.max_errors:
+                    reason = 'not_held'
+                    break
+                time.sleep(backoff_delay(not_held))
+            else:
+                errors = not_held = 0
+        self.on_stopped(self, reason)
+
 class NoteDeleter(Operation):
+    priority = PRIORITY_INTERACTIVE
+
     def __init__(self, group=None, target=None, name=None, args=(), kwargs={}, Verbose=None, note=None, simplenote_instance=None):
         Operation.__init__(self, group, target, name, args, kwargs, Verbose)
         self.note = note
@@ -150,7 +318,10 @@ class NoteDeleter(Operation):
     def get_update_run_text(self):
         return 'QuickSimplenote: Deleting note'
 
-    def run(self):
+    def get_keys(self):
+        return set([self.note['key']])
+
+    def run_operation(self):
         print('QuickSimplenote: Deleting %s' % self.note['key'])
         deletion_operation = self.simplenote_instance.trash_note(self.note['key'])
         if deletion_operation[1] == 0:
@@ -162,14 +333,21 @@ class NoteDeleter(Operation):
         return self.result
 
 class NoteUpdater(Operation):
-    def __init__(self, group=None, target=None, name=None, args=(), kwargs={}, Verbose=None, note=None, simplenote_instance=None):
+    priority = PRIORITY_INTERACTIVE
+
+    def __init__(self, group=None, target=None, name=None, args=(), kwargs={}, Verbose=None, note=None, simplenote_instance=None, get_version=None):
         Operation.__init__(self, group, target, name, args, kwargs, Verbose)
         self.note = note
         self.simplenote_instance = simplenote_instance
+        # Gives the version the update is based on once it runs, as the
+        # updates queued before it change it
+        self.get_version = get_version
 
-    def run(self):
+    def run_operation(self):
         print('QuickSimplenote: Updating %s' % self.note['key'])
         self.note['modifydate'] = time.time()
+        if self.get_version:
+            self.note['version'] = self.get_version()
 
         note_update_operation = self.simplenote_instance.update_note(self.note)
         if note_update_operation[1] == 0:
@@ -180,6 +358,20 @@ class NoteUpdater(Operation):
     def get_result(self):
         return self.result
 
+    def get_keys(self):
+        return set([self.note['key']])
+
+    def coalesce_into(self, operation):
+        # A waiting update of the same note just sends our content instead
+        if not isinstance(operation, NoteUpdater) or operation.note['key'] != self.note['key']:
+            return False
+        operation.note = self.note
+        operation.get_version = self.get_version
+        operation.callback = self.callback
+        operation.callback_kwargs = self.callback_kwargs
+        operation.exception_callback = self.exception_callback
+        return True
+
     def get_run_finished_text(self):
         return 'QuickSimplenote: Done'
 
@@ -1,15 +1,32 @@
 import sublime, sublime_plugin
-from simplenote import Simplenote
+from simplenote import Simplenote, Note, Metrics, CONNECTION_POOL_SIZE, CONCURRENCY_MAX, CONNECT_TIMEOUT, READ_TIMEOUT
 
 import functools
 import time
+import re
+import string
 import copy
-from collections import deque
-from os import path, makedirs, remove, listdir
+import json
+import hashlib
+from os import path, makedirs, remove, listdir, stat
 from datetime import datetime
-from threading import Semaphore, Lock
-
-from operations import NoteCreator, MultipleNoteContentDownloader, GetNotesDelta, NoteDeleter, NoteUpdater
+from threading import Lock, Thread
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+from operations import NoteCreator, MultipleNoteContentDownloader, GetNotesDelta, NoteDeleter, NoteUpdater, ChangeListener
+from operations import PRIORITY_OPEN, PRIORITY_BACKGROUND
+from note_store import NoteStore, NoteCache, ContentStore
+from search_index import SearchIndex
+
+FILENAME_CHARS = frozenset("-_.() %s%s" % (string.ascii_letters, string.digits))
+KEY_PATTERN = re.compile(ur'\((.*?)\)')
+# Most times sync_every is stretched while syncs bring no changes
+SYNC_IDLE_BACKOFF_MAX = 4
+# Longest wait before long polling again after it failed, in seconds
+PUSH_RETRY_MAX = 3600
 
 def cmp_to_key(mycmp):
     'Convert a cmp= function into a key= function'
@@ -31,15 +48,68 @@ def cmp_to_key(mycmp):
     return K
 
 def sort_notes(a_note, b_note):
-    if 'pinned' in a_note['systemtags']:
+    if 'pinned' in a_note.systemTags:
         return 1
-    elif 'pinned' in b_note['systemtags']:
+    elif 'pinned' in b_note.systemTags:
         return -1
     else:
-        date_a = datetime.fromtimestamp(float(a_note['modifydate']))
-        date_b = datetime.fromtimestamp(float(b_note['modifydate']))
+        date_a = datetime.fromtimestamp(float(a_note.modificationDate))
+        date_b = datetime.fromtimestamp(float(b_note.modificationDate))
         return cmp(date_a, date_b)
 
+def timed(function):
+    # Records how long each call takes in the timings metrics
+    @functools.wraps(function)
+    def timed_function(*args, **kwargs):
+        started = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timings.record(function.__name__, time.time() - started)
+    return timed_function
+
+def get_metrics():
+    operation_manager = OperationManager.instance()
+    metrics = {
+        'operations': operation_manager.metrics.snapshot(),
+        'coalesced_operations': operation_manager.coalesced_operations,
+        'avoided': dict(avoided),
+        'timings': timings.snapshot()
+    }
+    if simplenote_instance:
+        metrics['requests'] = simplenote_instance.metrics.snapshot()
+        metrics['connections_opened'] = simplenote_instance.pool.connections_opened
+        metrics['concurrency_limit'] = simplenote_instance.limiter.limit
+    return metrics
+
+def start_metrics_log():
+    global logging_metrics
+    log_every = settings.get('metrics_log_every')
+    if logging_metrics or not log_every or log_every <= 0:
+        return
+    logging_metrics = True
+    sublime.set_timeout(log_metrics, log_every * 1000)
+
+def log_metrics():
+    global logging_metrics
+    log_every = settings.get('metrics_log_every')
+    if not log_every or log_every <= 0:
+        logging_metrics = False
+        return
+    metrics = get_metrics()
+    entries = []
+    for group in ['requests', 'operations', 'timings']:
+        for name, entry in sorted(metrics.get(group, {}).items()):
+            text = '%s %dx %.0fms' % (name, entry['count'], entry['mean'] * 1000)
+            if 'bytes_in' in entry:
+                text += ' %dKB' % (entry['bytes_in'] / 1024)
+                if entry.get('bytes_decoded', 0) > entry['bytes_in']:
+                    text += ' (%dKB uncompressed)' % (entry['bytes_decoded'] / 1024)
+            entries.append(text)
+    entries.append('avoided %(writes)d writes %(reverts)d reverts %(uploads)d uploads' % avoided)
+    print('QuickSimplenote: Metrics: %s' % ', '.join(entries))
+    sublime.set_timeout(log_metrics, log_every * 1000)
+
 def show_message(message):
     if not message:
         message = ''
@@ -51,13 +121,67 @@ def remove_status():
     show_message(None)
 
 def write_note_to_path(note, filepath):
+    # Returns False if the file already had the note's content
+    content = None
+    digest = note.get('content_digest')
+    if digest is None or 'content' in note:
+        content = get_note_content(note) or ''
+        digest = get_digest(content)
+    if get_file_digest(filepath) == digest:
+        avoided['writes'] += 1
+        return False
+    if content is None:
+        content = get_note_content(note) or ''
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8')
     f = open(filepath, 'wb')
-    try:
-        content = note['content']
-        f.write(content)
-    except KeyError:
-        pass
+    f.write(content)
     f.close()
+    remember_file_digest(filepath, digest)
+    return True
+
+def get_digest(content):
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+def get_file_digest(filepath):
+    # Digest of the file's content, only hashed again if the file changed
+    try:
+        file_stat = stat(filepath)
+    except OSError:
+        return None
+    known = temp_digests.get(filepath)
+    if known and known[0] == (file_stat.st_size, file_stat.st_mtime):
+        return known[1]
+    with open(filepath, 'rb') as content_file:
+        digest = get_digest(content_file.read())
+    temp_digests[filepath] = ((file_stat.st_size, file_stat.st_mtime), digest)
+    return digest
+
+def remember_file_digest(filepath, digest):
+    file_stat = stat(filepath)
+    temp_digests[filepath] = ((file_stat.st_size, file_stat.st_mtime), digest)
+
+def has_content(note, digest):
+    known = note.get('content_digest')
+    if known is None:
+        # Stored before digests were kept
+        known = get_digest(get_note_content(note) or '')
+    return known == digest
+
+def get_note_content(note):
+    # Notes we got from the server carry their content, the ones
+    # we keep only have it on disk
+    if 'content' in note:
+        return note['content']
+    return note_contents.get(note['key'])
+
+def store_note_content(note):
+    # Only the title and a digest stay in memory
+    note['title'] = get_note_name(note)
+    note['content_digest'] = get_digest(note['content'])
+    note_contents.put(note['key'], note.pop('content'))
 
 def open_note(note, window=None):
     if not window:
@@ -66,24 +190,43 @@ def open_note(note, window=None):
     write_note_to_path(note, filepath)
     return window.open_file(filepath)
 
-def get_filename_for_note(note):
+def load_extension_rules():
+    # Compiles title_extension_map, the filenames they gave are now stale
+    global extension_rules, extension_map
+    extension_map = settings.get('title_extension_map')
+    extension_rules = []
+    for item in extension_map or []:
+        extension_rules.append((re.compile(item['title_regex'], re.UNICODE), '.' + item['extension']))
+    filename_parts.clear()
+
+def update_extension_rules():
+    # Sublime calls this on any settings change
+    if settings.get('title_extension_map') == extension_map:
+        return
+    load_extension_rules()
+    for note in notes:
+        if note.get('filename'):
+            note['filename'] = get_filename_for_note(note)
+            notes.refresh(note)
+
+def get_filename_parts(note_name):
     # Take out invalid characters from title and use that as base for the name
-    import string
-    valid_chars = "-_.() %s%s" % (string.ascii_letters, string.digits)
-    note_name = get_note_name(note)
-    base = ''.join(c for c in note_name if c in valid_chars)
+    base = ''.join(c for c in note_name if c in FILENAME_CHARS)
     # Determine extension based on title
-    extension_map = settings.get('title_extension_map')
-    extension = ''
-    if extension_map:
-        for item in extension_map:
-            import re
-            pattern = re.compile(item['title_regex'], re.UNICODE)
-            if re.search(pattern, note_name):
-                extension = '.' + item['extension']
-                break
+    for pattern, extension in extension_rules:
+        if pattern.search(note_name):
+            return base, extension
+    return base, ''
 
-    return base + ' (' + note['key'] + ')' + extension
+def get_filename_for_note(note):
+    # Names only depend on the title, so they are worked out once per title
+    note_name = get_note_name(note)
+    parts = filename_parts.get(note_name)
+    if parts is None:
+        if len(filename_parts) > max(1000, 2 * len(notes)):
+            filename_parts.clear()
+        parts = filename_parts[note_name] = get_filename_parts(note_name)
+    return parts[0] + ' (' + note['key'] + ')' + parts[1]
 
 def get_path_for_note(note):
     return path.join(temp_path, get_filename_for_note(note))
@@ -93,25 +236,20 @@ def get_note_from_path(view_filepath):
     if view_filepath:
         if path.dirname(view_filepath) == temp_path:
             note_filename = path.split(view_filepath)[1]
-            note = [note for note in notes if get_filename_for_note(note) == note_filename]
+            note = notes.get_by_filename(note_filename)
             if not note:
-                import re
-                pattern = re.compile(ur'\((.*?)\)')
-                results = re.findall(pattern, note_filename)
+                results = KEY_PATTERN.findall(note_filename)
                 if results:
                     noteKey = results[ len(results) - 1]
-                    note = [note for note in notes if note['key'] == noteKey]
-            if note:
-                note = note[0]
+                    note = notes.get(noteKey)
 
 
     return note
 
 def get_note_name(note):
-    try:
-        content = note['content']
-    except Exception, e:
-        return 'untitled'
+    content = note.get('content')
+    if content is None:
+        return note.get('title', 'untitled')
     index = content.find('\n');
     if index > -1:
         title = content[:index]
@@ -120,7 +258,8 @@ def get_note_name(note):
             title = content
         else:
             title = 'untitled'
-    title = title.decode('utf-8')
+    if isinstance(title, bytes):
+        title = title.decode('utf-8')
     return title
 
 def handle_open_filename_change(old_file_path, updated_note):
@@ -161,6 +300,7 @@ def handle_open_filename_change(old_file_path, updated_note):
             remove(old_file_path)
         except OSError as e:
             pass
+        temp_digests.pop(old_file_path, None)
         return True
     return False
 
@@ -176,24 +316,164 @@ def synch_note_resume(existing_note_entry, updated_note_resume):
     for key in updated_note_resume:
         existing_note_entry[key] = updated_note_resume[key]
 
+def get_resume(note):
+    # Content (and the filename it gives) is updated on merge
+    return dict((key, value) for key, value in note.items() if key != 'content')
+
 def update_note(existing_note, updated_note):
     synch_note_resume(existing_note, updated_note)
     existing_note['local_modifydate'] = time.time()
+    # Server version the content we have belongs to, an answer
+    # about an older one doesn't take it back
+    version = existing_note.get('version')
+    synced_version = existing_note.get('synced_version')
+    if synced_version is not None and (version is None or version < synced_version):
+        version = existing_note['version'] = synced_version
+    existing_note['synced_version'] = version
     existing_note['needs_update'] = False
     existing_note['filename'] = get_filename_for_note(existing_note)
+    search_index.update(existing_note)
+    if 'content' in existing_note:
+        store_note_content(existing_note)
+
+def get_base_version(note):
+    # Version the content we have belongs to, for the updates
+    # made from it (a newer one may not be downloaded yet)
+    if note.get('synced_version') is not None:
+        return note['synced_version']
+    return note.get('version')
+
+def is_outdated(existing_note, note_resume):
+    # Raises KeyError for notes that never got their content
+    synced_version = getattr(existing_note, 'synced_version', None)
+    version = getattr(note_resume, 'version', None)
+    if synced_version is not None and version is not None:
+        return synced_version < version
+    # Cached before versions were tracked
+    return existing_note['local_modifydate'] < float(note_resume['modifydate'])
 
 def load_notes():
-    notes = []
+    cached_notes = note_cache.load()
+    # Caches from before notes were Note objects and contents were kept apart
+    migrated_notes = [note for note in cached_notes if not isinstance(note, Note) or 'content' in note]
+    loaded_notes = NoteStore([Note(note) if not isinstance(note, Note) else note for note in cached_notes])
+    for note in loaded_notes:
+        if 'content' in note:
+            store_note_content(note)
+    if migrated_notes:
+        note_cache.compact(loaded_notes)
+    # Notes whose content went missing are downloaded again
+    stored_keys = note_contents.keys()
+    for note in loaded_notes:
+        if not note['key'] in stored_keys:
+            note['synced_version'] = None
+            note['needs_update'] = True
+            note.pop('local_modifydate', None)
+    return loaded_notes
+
+@timed
+def save_notes(notes, changed_notes=(), deleted_keys=()):
+    # Only the changes are written, the whole set is written
+    # when the cache gets compacted
+    note_cache.write(changed_notes, deleted_keys)
+    if note_cache.needs_compaction(len(notes)):
+        note_cache.compact(notes)
+    search_index.remove(deleted_keys)
+    note_contents.remove(deleted_keys)
+    schedule_search_index_save()
+
+def load_search_index(loaded_notes):
+    # Only the notes that changed since it was saved get reindexed
+    index = SearchIndex.load(path.join(package_path, 'search_index'))
+    index.sync(loaded_notes, get_note_content)
+    return index
+
+@timed
+def save_search_index():
+    global saving_search_index
+    saving_search_index = False
+    if search_index.dirty:
+        search_index.save(path.join(package_path, 'search_index'))
+
+def schedule_search_index_save():
+    # Saves are batched, the index is rewritten as a whole
+    global saving_search_index
+    if saving_search_index or not search_index.dirty:
+        return
+    saving_search_index = True
+    sublime.set_timeout(save_search_index, 10000)
+
+def clean_temp_path(loaded_notes):
+    # Remove the files of notes we don't have anymore
+    note_files = set(note.filename for note in loaded_notes if note.get('filename'))
+    for filename in set(listdir(temp_path)) - note_files:
+        try:
+            remove(path.join(temp_path, filename))
+        except OSError as e:
+            # A folder, or a file another program keeps open
+            print('QuickSimplenote: Could not remove %s: %s' % (filename, e))
+
+def load_cache():
+    # Runs on a thread at startup, so loading the plugin doesn't wait for it
+    started = time.time()
+    loaded_notes, cursor, index = NoteStore(), None, SearchIndex()
     try:
-        with open(path.join(package_path, 'note_cache'),'rb') as cache_file:
-            notes = pickle.load(cache_file)
+        loaded_notes = load_notes()
+        cursor = load_cursor()
+        index = load_search_index(loaded_notes)
+        clean_temp_path(loaded_notes)
+    except Exception as e:
+        # Without a cursor the next sync downloads whatever is missing
+        print('QuickSimplenote: Loading the note cache failed: %r' % e)
+    finally:
+        # Commands wait for the load, so it finishes with what could be read
+        timings.record('load_cache', time.time() - started)
+        sublime.set_timeout(functools.partial(finish_loading, loaded_notes, cursor, index), 0)
+
+def finish_loading(loaded_notes, cursor, index):
+    global notes, note_cursor, search_index, loaded, waiting_for_load
+    notes = loaded_notes
+    note_cursor = cursor
+    search_index = index
+    loaded = True
+    schedule_search_index_save()
+    callbacks = waiting_for_load
+    waiting_for_load = []
+    if callbacks:
+        remove_status()
+    for callback in callbacks:
+        callback()
+
+def when_loaded(callback):
+    # Runs the callback once the cache is loaded
+    if loaded:
+        callback()
+        return
+    if not waiting_for_load:
+        show_message('QuickSimplenote: Loading notes')
+    waiting_for_load.append(callback)
+
+def after_loading(function):
+    # For commands and events that need the notes
+    @functools.wraps(function)
+    def wait_and_run(*args, **kwargs):
+        when_loaded(functools.partial(function, *args, **kwargs))
+    return wait_and_run
+
+def load_cursor():
+    cursor = None
+    try:
+        with open(path.join(package_path, 'note_cursor'),'rb') as cursor_file:
+            cursor = pickle.load(cursor_file)
     except (EOFError, IOError) as e:
         pass
-    return notes
+    return cursor
 
-def save_notes(notes):
-    with open(path.join(package_path, 'note_cache'),'w+b') as cache_file:
-        pickle.dump(notes, cache_file)
+def save_cursor(cursor):
+    global note_cursor
+    note_cursor = cursor
+    with open(path.join(package_path, 'note_cursor'),'w+b') as cursor_file:
+        pickle.dump(cursor, cursor_file)
 
 class OperationManager:
     _instance = None
@@ -207,58 +487,158 @@ class OperationManager:
         return cls._instance
 
     def __init__(self):
-        self.operations = deque([])
+        # Waiting operations in the order they were added
+        self.operations = []
+        self.running_operations = []
+        # Operations put themselves here when they are done
+        self.finished_operations = Queue()
         self.running = False
-        self.current_operation = None
+        self.updating_status = False
+        # Operations that didn't need to run (e.g. repeated saves)
+        self.coalesced_operations = 0
+        # Time waiting and running by operation class
+        self.metrics = Metrics()
 
     def is_running(self):
         return self.running
 
+    def has_operations_for(self, note_key):
+        return any(note_key in operation.get_keys() for operation in self.operations + self.running_operations)
+
     def add_operation(self, operation):
+        # Let the operation fold into the last waiting one on the same notes
+        keys = operation.get_keys()
+        if keys:
+            for queued_operation in reversed(self.operations):
+                if queued_operation.get_keys() & keys:
+                    if operation.coalesce_into(queued_operation):
+                        self.coalesced_operations += 1
+                        print('QuickSimplenote: Coalesced with a waiting %s (%d saved so far)' % (queued_operation.__class__.__name__, self.coalesced_operations))
+                        return
+                    break
+
+        operation.queued_at = time.time()
         self.operations.append(operation)
+        self.start_operations()
         if (not self.running):
             self.run()
 
-    def check_operations(self):
+    def operation_finished(self, operation):
+        # Called from the operation's thread, hop to the main one
+        operation.finished_at = time.time()
+        self.finished_operations.put(operation)
+        sublime.set_timeout(self.check_operations, 0)
 
-        if self.current_operation == None:
-            return
-
-        # If it's still running, update the status
-        if self.current_operation.is_alive():
-            text = self.current_operation.get_update_run_text()
+    def check_operations(self):
+        # Call the callbacks of the finished operations
+        # and start the next ones
+        text = None
+        while True:
+            try:
+                operation = self.finished_operations.get_nowait()
+            except Empty:
+                break
+            if operation in self.running_operations:
+                self.running_operations.remove(operation)
+                name = operation.__class__.__name__
+                self.metrics.record(name + '.wait', operation.started_at - operation.queued_at)
+                self.metrics.record(name + '.run', operation.finished_at - operation.started_at)
+                text = operation.get_run_finished_text()
+                operation.join()
+        self.start_operations()
+        self.stop_if_idle()
+
+        if text:
+            show_message(text)
+
+    def stop_if_idle(self):
+        if self.running and not self.running_operations:
+            self.running = False
+            sublime.set_timeout(remove_status, 1000)
+
+    def cancel_operation(self, operation):
+        # A running operation can't be stopped, but we stop waiting for it:
+        # its lane and notes are freed and its result is ignored
+        if operation in self.operations:
+            self.operations.remove(operation)
+        elif operation in self.running_operations:
+            self.running_operations.remove(operation)
+            operation.cancel()
         else:
-            # If not running, show finished text
-            # call callback with result and do the
-            # next operation
-            text = self.current_operation.get_run_finished_text()
-            self.current_operation.join()
-            if len( self.operations ) > 0:
-                self.start_next_operation()
-            else:
-                self.running = False
-                sublime.set_timeout(remove_status, 1000)
+            return
+        print('QuickSimplenote: Cancelled %s' % operation.__class__.__name__)
+        self.start_operations()
+        self.stop_if_idle()
 
-        show_message(text)
-        if self.running:
-            sublime.set_timeout(self.check_operations, 1000)
+    def check_deadlines(self):
+        timeout = settings.get('operation_timeout')
+        if not timeout or timeout <= 0:
+            return
+        now = time.time()
+        for operation in [operation for operation in self.running_operations if now - operation.started_at > timeout]:
+            print('QuickSimplenote: %s took more than %ss' % (operation.__class__.__name__, timeout))
+            self.cancel_operation(operation)
+
+    def update_status(self):
+        if not self.running:
+            self.updating_status = False
+            return
+        self.check_deadlines()
+        if self.running_operations:
+            show_message(min(self.running_operations, key=lambda operation: operation.priority).get_update_run_text())
+        sublime.set_timeout(self.update_status, 1000)
 
     def run(self):
-        self.start_next_operation()
-        sublime.set_timeout(self.check_operations, 1000)
         self.running = True
+        if not self.updating_status:
+            self.updating_status = True
+            sublime.set_timeout(self.update_status, 1000)
+
+    def get_lanes(self):
+        lanes = settings.get('concurrent_operations')
+        if not lanes or lanes < 1:
+            lanes = 2
+        return lanes
+
+    def start_operations(self):
+        lanes = self.get_lanes()
+        # Keep a lane free from background work so saves don't wait on a sync
+        background_lanes = max(1, lanes - 1)
+        while len(self.running_operations) < lanes:
+            busy_keys = set()
+            running_background = 0
+            for operation in self.running_operations:
+                busy_keys |= operation.get_keys()
+                if operation.priority == PRIORITY_BACKGROUND:
+                    running_background += 1
+
+            # An operation can start if no running or earlier waiting
+            # operation works on the same notes
+            candidates = []
+            for index, operation in enumerate(self.operations):
+                keys = operation.get_keys()
+                if not keys & busy_keys:
+                    if operation.priority != PRIORITY_BACKGROUND or running_background < background_lanes:
+                        candidates.append((operation.priority, index, operation))
+                busy_keys |= keys
+            if not candidates:
+                break
 
-    def start_next_operation(self):
-        self.current_operation = self.operations.popleft()
-        self.current_operation.start()
+            next_operation = min(candidates)[2]
+            self.operations.remove(next_operation)
+            self.running_operations.append(next_operation)
+            next_operation.set_finished_callback(self.operation_finished)
+            next_operation.started_at = time.time()
+            next_operation.start()
 
 class HandleNoteViewCommand(sublime_plugin.EventListener):
 
     waiting_to_save = []
+    @after_loading
     def on_modified(self, view):
 
         def flush_saves():
-            if OperationManager.instance().is_running():
+            if OperationManager.instance().has_operations_for(note['key']):
                 sublime.set_timeout(flush_saves, 1000)
                 return
 
@@ -294,6 +674,7 @@ class HandleNoteViewCommand(sublime_plugin.EventListener):
                 HandleNoteViewCommand.waiting_to_save.append(new_entry)
             sublime.set_timeout(flush_saves, debounce_time)
 
+    @after_loading
     def on_load(self, view):
         view_filepath = view.file_name()
         note = get_note_from_path(view_filepath)
@@ -314,40 +695,48 @@ class HandleNoteViewCommand(sublime_plugin.EventListener):
         global notes
         # We get all the resume data back. We have to merge it
         # with our data (extended fields and content)
-        for note in notes:
-            if note['key'] == modified_note_resume['key']:
-                # Set content to the updated one
-                # or to the view's content if we don't have any update
-                updated_from_server = False
-                if not 'content' in modified_note_resume:
-                    modified_note_resume['content'] = content
-                else:
-                    updated_from_server = True
-                update_note(note, modified_note_resume) # Update all fields
-                name_changed = handle_open_filename_change(old_file_path, note)
-                # If we didn't reopen the view with the name changed, but the content has changed
-                # we have to update the view anyway
-                if updated_from_server and not name_changed:
-                    filepath = get_path_for_note(note)
-                    write_note_to_path(note, filepath)
+        note = notes.get(modified_note_resume['key'])
+        if note:
+            # Set content to the updated one
+            # or to the view's content if we don't have any update
+            updated_from_server = False
+            if not 'content' in modified_note_resume:
+                modified_note_resume['content'] = content
+            else:
+                updated_from_server = True
+            update_note(note, modified_note_resume) # Update all fields
+            notes.refresh(note)
+            name_changed = handle_open_filename_change(old_file_path, note)
+            # If we didn't reopen the view with the name changed, but the content has changed
+            # we have to update the view anyway
+            if updated_from_server and not name_changed:
+                filepath = get_path_for_note(note)
+                if write_note_to_path(note, filepath):
                     sublime.set_timeout(functools.partial(open_view.run_command, 'revert'), 0)
-                break
+                else:
+                    avoided['reverts'] += 1
+            save_notes(notes, [note])
         notes.sort(key=cmp_to_key(sort_notes), reverse=True)
-        save_notes(notes)
 
+    @after_loading
     def on_post_save(self, view):
         view_filepath = view.file_name()
         note = get_note_from_path(view_filepath)
         if note:
-            # Update with new content
-            updated_note = copy.deepcopy(note)
+            content = self.get_current_content(view)
             # Handle when the note changes elsewhere and the user goes to that tab:
             # sublime reloads the view, it's handled as changed and sent here
-            if 'content' in updated_note and updated_note['content'] == self.get_current_content(view):
+            if has_content(note, get_digest(content)):
+                avoided['uploads'] += 1
                 return
-            updated_note['content'] = self.get_current_content(view)
+            # Someone is around, don't wait long for their other changes
+            track_idle(True)
+            # Update with new content
+            updated_note = copy.copy(note)
+            updated_note['content'] = content
             # Send update
-            update_op = NoteUpdater(note=updated_note, simplenote_instance=simplenote_instance)
+            update_op = NoteUpdater(note=updated_note, simplenote_instance=simplenote_instance,
+                get_version=functools.partial(get_base_version, note))
             update_op.set_callback(self.handle_note_changed,
                 {'content': updated_note['content'],
                  'old_file_path': view_filepath,
@@ -363,6 +752,7 @@ class ShowQuickSimplenoteNotesCommand(sublime_plugin.ApplicationCommand):
         selected_note = notes[selected_index]
         open_note(selected_note)
 
+    @after_loading
     def run(self):
         if not started:
             if not start():
@@ -384,51 +774,98 @@ class StartQuickSimplenoteSyncCommand(sublime_plugin.ApplicationCommand):
         notes = new_notes
         notes.sort(key=cmp_to_key(sort_notes), reverse=True)
 
-    def merge_delta(self, updated_note_resume, existing_notes):
+    @timed
+    def merge_delta(self, delta, existing_notes, seen_keys=None):
         # Here we create the note_resume we use on the rest of the app.
         # The note_resume we store consists of:
         #   The note resume as it comes from the simplenote api.
         #   The title, filename and last modified date of the local cache entry
+        # The delta is either the full index or only the changes since
+        # the last cursor, in which case deletions come flagged. A full
+        # index that was streamed comes empty, its pages were merged as
+        # they arrived (merge_page) and seen_keys has their keys
+        updated_note_resume, cursor, full_index = delta
+        deleted_keys = []
+
+        if not full_index:
+            deleted_keys = [note.key for note in updated_note_resume if note.deleted and note.key in existing_notes]
+            existing_notes.discard(deleted_keys)
+            updated_note_resume = [note for note in updated_note_resume if not note.deleted]
+
+        changed_notes, index_notes = self.merge_resume(updated_note_resume, existing_notes)
+
+        # Look at the existing notes to find deletions
+        if full_index:
+            updated_note_resume_keys = set([note.key for note in updated_note_resume])
+            if seen_keys is not None:
+                updated_note_resume_keys |= seen_keys
+            deleted_keys = [key for key in existing_notes.keys() if key not in updated_note_resume_keys]
+            existing_notes.discard(deleted_keys)
+
+        save_notes(existing_notes, changed_notes, deleted_keys)
+        save_cursor(cursor)
+        track_idle(full_index or bool(changed_notes or deleted_keys))
+        listen_for_changes()
+        if not full_index:
+            # Also retries the notes whose download failed before
+            self.notes_synch(existing_notes, index_notes)
+        else:
+            # Every note was in the index, and the streamed pages
+            # started their updates already
+            self.notes_synch(existing_notes, index_notes, changed_notes)
+            self.set_result(existing_notes)
+
+    @timed
+    def merge_page(self, page, existing_notes, seen_keys):
+        # A page of the full index, merged while the next ones download
+        seen_keys.update([note.key for note in page])
+        changed_notes, index_notes = self.merge_resume(page, existing_notes)
+        save_notes(existing_notes, changed_notes)
+        self.notes_synch(existing_notes, index_notes, changed_notes)
+
+    def merge_resume(self, updated_note_resume, existing_notes):
+        changed_notes = []
+        # Notes to update whose content came along with the resume
+        # (data=true), these don't need to be downloaded again
+        index_notes = {}
 
         # Look at the new resume and find existing entries
         for current_updated_note_resume in updated_note_resume:
-            existing_note_entry = None
-            for existing_note in existing_notes:
-                if existing_note['key'] == current_updated_note_resume['key']:
-                    existing_note_entry = existing_note
-                    break
+            existing_note_entry = existing_notes.get(current_updated_note_resume.key)
             # If we have it already
             if existing_note_entry:
                 # Mark for update if needed
                 try:
                     # Note with old content
-                    if existing_note_entry['local_modifydate'] < float(current_updated_note_resume['modifydate']):
-                        synch_note_resume(existing_note_entry, current_updated_note_resume)
+                    if is_outdated(existing_note_entry, current_updated_note_resume):
+                        synch_note_resume(existing_note_entry, get_resume(current_updated_note_resume))
                         existing_note_entry['needs_update'] = True
-                    else:
+                        changed_notes.append(existing_note_entry)
+                    elif existing_note_entry.needs_update:
                         # Up to date note
                         existing_note_entry['needs_update'] = False
+                        changed_notes.append(existing_note_entry)
                 except KeyError as e:
                     # Note that never got the content downloaded:
                     existing_note_entry['needs_update'] = True
+                    changed_notes.append(existing_note_entry)
 
             # New note
             else:
-                new_note_entry = {'needs_update': True}
-                synch_note_resume(new_note_entry, current_updated_note_resume)
-                existing_notes.append(new_note_entry)
+                new_note_entry = Note(needs_update=True)
+                synch_note_resume(new_note_entry, get_resume(current_updated_note_resume))
+                existing_notes.add(new_note_entry)
+                existing_note_entry = new_note_entry
+                changed_notes.append(new_note_entry)
 
-        # Look at the existing notes to find deletions
-        updated_note_resume_keys = [note['key'] for note in updated_note_resume]
-        deleted_notes = [deleted_note for deleted_note in existing_notes if deleted_note['key'] not in updated_note_resume_keys]
-        for deleted_note in deleted_notes:
-            existing_notes.remove(deleted_note)
+            if existing_note_entry.needs_update and 'content' in current_updated_note_resume:
+                index_notes[current_updated_note_resume.key] = current_updated_note_resume
 
-        save_notes(existing_notes)
-        self.notes_synch(existing_notes)
+        return changed_notes, index_notes
 
-    def notes_synch(self, notes):
-        # Here we synch updated notes in order of priority.
+    def notes_synch(self, notes, index_notes={}, candidates=None):
+        # Here we synch updated notes (out of the candidates, if given)
+        # in order of priority.
         # Open notes:
         #   Locally unsaved
         #   Locally saved
@@ -450,9 +887,11 @@ class StartQuickSimplenoteSyncCommand(sublime_plugin.ApplicationCommand):
         lu = []
         ls = []
         others = []
-        for note in notes:
+        if candidates is None:
+            candidates = notes
+        for note in candidates:
 
-            if not note['needs_update']:
+            if not note.needs_update:
                 continue
 
             try:
@@ -474,19 +913,27 @@ class StartQuickSimplenoteSyncCommand(sublime_plugin.ApplicationCommand):
         others.sort(key=cmp_to_key(sort_notes), reverse=True)
 
         # Start updates
-        sem = Semaphore(3)
         show_message('QuickSimplenote: Downloading content')
         if lu:
-            down_op = MultipleNoteContentDownloader(sem, simplenote_instance=simplenote_instance, notes=lu)
-            down_op.set_callback(self.merge_open, {'existing_notes':notes, 'dirty':True})
-            OperationManager.instance().add_operation(down_op)
+            self.update_contents(lu, index_notes, PRIORITY_OPEN, self.merge_open, {'existing_notes':notes, 'dirty':True})
         if ls:
-            down_op = MultipleNoteContentDownloader(sem, simplenote_instance=simplenote_instance, notes=ls)
-            down_op.set_callback(self.merge_open, {'existing_notes':notes})
-            OperationManager.instance().add_operation(down_op)
+            self.update_contents(ls, index_notes, PRIORITY_OPEN, self.merge_open, {'existing_notes':notes})
         if others:
-            down_op = MultipleNoteContentDownloader(sem, simplenote_instance=simplenote_instance, notes=others)
-            down_op.set_callback(self.merge_notes, {'existing_notes':notes})
+            self.update_contents(others, index_notes, PRIORITY_BACKGROUND, self.merge_notes, {'existing_notes':notes})
+
+    def update_contents(self, notes_to_update, index_notes, priority, callback, callback_kwargs):
+        # Notes that got their content with the resume are merged right away,
+        # only the rest is downloaded
+        from_index = [index_notes[note['key']] for note in notes_to_update if note['key'] in index_notes]
+        to_download = [note for note in notes_to_update if not note['key'] in index_notes]
+        if from_index:
+            callback(from_index, **callback_kwargs)
+        if to_download:
+            down_op = MultipleNoteContentDownloader(simplenote_instance=simplenote_instance, notes=to_download,
+                workers=settings.get('download_workers') or CONCURRENCY_MAX,
+                partial_results=settings.get('download_partial_results'),
+                priority=priority)
+            down_op.set_callback(callback, callback_kwargs)
             OperationManager.instance().add_operation(down_op)
 
     def merge_open(self, updated_notes, existing_notes, dirty=False):
@@ -506,43 +953,54 @@ class StartQuickSimplenoteSyncCommand(sublime_plugin.ApplicationCommand):
 
             if ( not dirty ) or update or auto_overwrite_on_conflict:
                 # Update notes if the change is clean, or we were asked to update
-                for note in existing_notes:
-                    for updated_note in updated_notes:
-                        # If we find the updated note
-                        if note['key'] == updated_note['key']:
-                            old_file_path = get_path_for_note(note)
-                            new_file_path = get_path_for_note(updated_note)
-                            # Update contents
-                            write_note_to_path(updated_note, new_file_path)
-                            # Handle filename change (note has the old filename value)
-                            handle_open_filename_change(old_file_path, updated_note)
-                            # Reload view of the note if it's selected
-                            for view in [window.active_view() for window in sublime.windows()]:
-                                if view.file_name() == new_file_path:
+                for updated_note in updated_notes:
+                    note = existing_notes.get(updated_note['key'])
+                    # If we find the updated note
+                    if note:
+                        old_file_path = get_path_for_note(note)
+                        new_file_path = get_path_for_note(updated_note)
+                        # Update contents
+                        written = write_note_to_path(updated_note, new_file_path)
+                        # Handle filename change (note has the old filename value)
+                        handle_open_filename_change(old_file_path, updated_note)
+                        # Reload view of the note if it's selected
+                        for view in [window.active_view() for window in sublime.windows()]:
+                            if view.file_name() == new_file_path:
+                                if written:
                                     sublime.set_timeout(functools.partial(view.run_command, 'revert'), 0)
-                            break
+                                else:
+                                    avoided['reverts'] += 1
 
             # Merge
             self.merge_notes(updated_notes, existing_notes)
 
+    @timed
     def merge_notes(self, updated_notes, existing_notes):
         # Merge
-        for note in existing_notes:
-
-            if not note['needs_update']:
-                continue
-
-            for updated_note in updated_notes:
-                if note['key'] == updated_note['key']:
-                    update_note(note, updated_note)
-
-        save_notes(existing_notes)
+        merged_notes = []
+        for updated_note in updated_notes:
+            note = existing_notes.get(updated_note.key)
+            if note and note.needs_update:
+                update_note(note, updated_note)
+                existing_notes.refresh(note)
+                merged_notes.append(note)
+
+        save_notes(existing_notes, merged_notes)
         self.set_result(existing_notes)
 
+    @after_loading
     def run(self):
         show_message('QuickSimplenote: Synching')
-        get_delta_op = GetNotesDelta(simplenote_instance=simplenote_instance)
-        get_delta_op.set_callback(self.merge_delta, {'existing_notes':notes})
+        # Only ask for changes if we have something to apply them to,
+        # otherwise (cold start) get the full index
+        cursor = None
+        if notes:
+            cursor = note_cursor
+        seen_keys = set()
+        def page_arrived(page):
+            sublime.set_timeout(functools.partial(self.merge_page, page, notes, seen_keys), 0)
+        get_delta_op = GetNotesDelta(simplenote_instance=simplenote_instance, cursor=cursor, page_callback=page_arrived)
+        get_delta_op.set_callback(self.merge_delta, {'existing_notes':notes, 'seen_keys':seen_keys})
         OperationManager.instance().add_operation(get_delta_op)
 
 class CreateQuickSimplenoteNoteCommand(sublime_plugin.ApplicationCommand):
@@ -551,11 +1009,12 @@ class CreateQuickSimplenoteNoteCommand(sublime_plugin.ApplicationCommand):
         if result:
             global notes
             update_note(result, result)
-            notes.append(result)
+            notes.add(result)
             notes.sort(key=cmp_to_key(sort_notes), reverse=True)
-            save_notes(notes)
+            save_notes(notes, [result])
             open_note(result)
 
+    @after_loading
     def run(self):
         creation_op = NoteCreator(simplenote_instance=simplenote_instance)
         creation_op.set_callback(self.handle_new_note)
@@ -566,13 +1025,15 @@ class DeleteQuickSimplenoteNoteCommand(sublime_plugin.ApplicationCommand):
     def handle_deletion(self, result):
         global notes
         notes.remove(self.note)
-        save_notes(notes)
+        save_notes(notes, deleted_keys=[self.note['key']])
         try:
             remove(get_path_for_note(self.note))
         except OSError as e:
             pass
+        temp_digests.pop(get_path_for_note(self.note), None)
         close_view(self.note_view)
 
+    @after_loading
     def run(self):
 
         self.note_view = sublime.active_window().active_view()
@@ -582,25 +1043,207 @@ class DeleteQuickSimplenoteNoteCommand(sublime_plugin.ApplicationCommand):
             deletion_op.set_callback(self.handle_deletion)
             OperationManager.instance().add_operation(deletion_op)
 
-def sync():
-    if not OperationManager.instance().is_running():
+class SearchQuickSimplenoteNotesCommand(sublime_plugin.ApplicationCommand):
+
+    def search(self, query, limit=50):
+        return [notes.get(key) for key in search_index.search(query, limit) if key in notes]
+
+    def get_snippet(self, note, query):
+        # First line after the title with one of the words, or the tags
+        content = get_note_content(note) or ''
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'replace')
+        words = query.lower().split()
+        for line in content.split('\n')[1:]:
+            lower_line = line.lower()
+            if any(word in lower_line for word in words):
+                return line.strip()[:80]
+        return ', '.join(note.get('tags') or [])
+
+    def handle_change(self, query):
+        # Show the best matches while typing
+        found = self.search(query, 3)
+        if found:
+            show_message('QuickSimplenote: %s' % ' | '.join(get_note_name(note) for note in found))
+        else:
+            remove_status()
+
+    def handle_done(self, query):
+        remove_status()
+        self.found = self.search(query)
+        if not self.found:
+            show_message('QuickSimplenote: No notes found')
+            sublime.set_timeout(remove_status, 2000)
+            return
+        items = [[get_note_name(note), self.get_snippet(note, query)] for note in self.found]
+        sublime.active_window().show_quick_panel(items, self.handle_selected)
+
+    def handle_selected(self, selected_index):
+        if not selected_index > -1:
+            return
+        open_note(self.found[selected_index])
+
+    @after_loading
+    def run(self):
+        if not started:
+            if not start():
+                return
+
+        sublime.active_window().show_input_panel('Search notes:', '', self.handle_done, self.handle_change, remove_status)
+
+class ShowQuickSimplenoteOperationsCommand(sublime_plugin.ApplicationCommand):
+
+    def handle_selected(self, selected_index):
+        if not selected_index > -1:
+            return
+        OperationManager.instance().cancel_operation(self.operations[selected_index])
+
+    def run(self):
+        operation_manager = OperationManager.instance()
+        self.operations = operation_manager.running_operations + operation_manager.operations
+        if not self.operations:
+            show_message('QuickSimplenote: Nothing running')
+            sublime.set_timeout(remove_status, 2000)
+            return
+
+        now = time.time()
+        items = []
+        for operation in self.operations:
+            if operation in operation_manager.running_operations:
+                state = 'Running for %ds' % (now - operation.started_at)
+            else:
+                state = 'Waiting for %ds' % (now - operation.queued_at)
+            items.append(['%s: %s' % (operation.__class__.__name__, operation.get_update_run_text()),
+                          '%s (select to cancel)' % state])
+        sublime.active_window().show_quick_panel(items, self.handle_selected)
+
+class ShowQuickSimplenoteMetricsCommand(sublime_plugin.ApplicationCommand):
+
+    def run(self):
+        filepath = path.join(package_path, 'metrics.json')
+        with open(filepath, 'w') as metrics_file:
+            json.dump(get_metrics(), metrics_file, indent=4, sort_keys=True)
+        sublime.active_window().open_file(filepath)
+
+def sync(timer=None):
+    if timer is not None and timer != sync_timer:
+        # Replaced by a sooner one
+        return
+    if change_listener is not None:
+        # Changes come as they happen
+        pass
+    elif not OperationManager.instance().is_running():
         print('QuickSimplenote: Syncing: %s' % time.time())
         sublime.run_command('start_quick_simplenote_sync');
     else:
         print('QuickSimplenote: Sync ommited %s' % time.time())
     sync_every = settings.get('sync_every')
     if sync_every > 0:
-        sublime.set_timeout(sync, sync_every * 1000)
+        schedule_sync(get_sync_delay(sync_every))
+
+def schedule_sync(delay):
+    # Timeouts can't be cancelled, the ones replaced return right away
+    global sync_timer, sync_due_at
+    sync_timer += 1
+    sync_due_at = time.time() + delay
+    sublime.set_timeout(functools.partial(sync, sync_timer), delay * 1000)
+
+def get_sync_delay(sync_every):
+    # Waits longer after syncs that brought nothing
+    return sync_every * min(2 ** idle_syncs, SYNC_IDLE_BACKOFF_MAX)
+
+def track_idle(active):
+    global idle_syncs
+    if active:
+        idle_syncs = 0
+        # The next sync may be waiting out the backoff, bring it closer
+        sync_every = settings.get('sync_every')
+        if sync_due_at is not None and sync_every > 0 and time.time() + sync_every < sync_due_at:
+            schedule_sync(sync_every)
+    elif 2 ** idle_syncs < SYNC_IDLE_BACKOFF_MAX:
+        idle_syncs += 1
+
+def listen_for_changes():
+    # Once a sync left us a cursor, long poll for the changes after it
+    # instead of syncing every now and then
+    global change_listener
+    if change_listener is not None or not settings.get('push_sync'):
+        return
+    if simplenote_instance is None or not note_cursor or time.time() < push_retry_at:
+        return
+    change_listener = ChangeListener(simplenote_instance=simplenote_instance, cursor=note_cursor,
+        on_changes=changes_arrived, on_stopped=listener_stopped)
+    change_listener.start()
+    print('QuickSimplenote: Listening for changes')
+
+def stop_listening():
+    global change_listener
+    if change_listener is not None:
+        change_listener.stop()
+        change_listener = None
+
+def changes_arrived(listener, changed_notes, cursor):
+    # From the listener's thread
+    sublime.set_timeout(functools.partial(merge_changes, listener, changed_notes, cursor), 0)
+
+def merge_changes(listener, changed_notes, cursor):
+    if listener is not change_listener:
+        return
+    merge_changes_when_idle(changed_notes, cursor)
+
+def merge_changes_when_idle(changed_notes, cursor):
+    # Our own saves come back as changes too, often before their update
+    # set the synced version, so changes to notes with operations on the
+    # way wait for them instead of being taken for conflicts
+    busy_keys = set([note.key for note in changed_notes if OperationManager.instance().has_operations_for(note.key)])
+    if busy_keys:
+        waiting_notes = [note for note in changed_notes if note.key in busy_keys]
+        changed_notes = [note for note in changed_notes if not note.key in busy_keys]
+        sublime.set_timeout(functools.partial(merge_changes_when_idle, waiting_notes, None), 1000)
+        if not changed_notes and cursor is None:
+            return
+    # Same as the changes a sync gets, open notes go through the conflict handling
+    StartQuickSimplenoteSyncCommand().merge_delta((changed_notes, cursor or note_cursor, False), notes)
+
+def listener_stopped(listener, reason):
+    # From the listener's thread
+    sublime.set_timeout(functools.partial(fall_back_to_polling, listener, reason), 0)
+
+def fall_back_to_polling(listener, reason):
+    global change_listener, push_failures, push_retry_at
+    if listener is not change_listener:
+        return
+    change_listener = None
+    if reason == 'cursor':
+        # A sync gets the full note list, then listening starts over
+        sublime.run_command('start_quick_simplenote_sync')
+        return
+    # Syncs happen every sync_every seconds meanwhile
+    push_failures += 1
+    delay = min(PUSH_RETRY_MAX, (settings.get('sync_every') or 30) * 2 ** push_failures)
+    push_retry_at = time.time() + delay
+    print('QuickSimplenote: Listening for changes stopped (%s), trying again in %ds' % (reason, delay))
 
 def start():
-    global started, simplenote_instance, settings
+    global started, simplenote_instance, settings, push_failures, push_retry_at
 
     username = settings.get('username')
     password = settings.get('password')
 
+    stop_listening()
+    push_failures = 0
+    push_retry_at = 0
     if (username and password):
-        simplenote_instance = Simplenote(username, password)
+        pool_size = settings.get('connection_pool_size')
+        if pool_size is None:
+            pool_size = CONNECTION_POOL_SIZE
+        simplenote_instance = Simplenote(username, password, pool_size,
+            max_concurrency=settings.get('download_workers') or CONCURRENCY_MAX,
+            connect_timeout=settings.get('connect_timeout') or CONNECT_TIMEOUT,
+            read_timeout=settings.get('read_timeout') or READ_TIMEOUT,
+            token_path=path.join(package_path, 'token'))
         sync()
+        start_metrics_log()
         started = True
     else:
         filepath = path.join(package_path, 'quick_simplenote.sublime-settings')
@@ -620,28 +1263,57 @@ def reload_if_needed():
         return
 
     if settings.get('autostart'):
-        sublime.set_timeout(start, 2000) # I know...
+        when_loaded(start)
         print('QuickSimplenote: Autostarting')
 
 reload_calls = -1
 simplenote_instance = None
 started = False
-notes = []
+logging_metrics = False
+saving_search_index = False
+loaded = False
+# Long polls the changes feed while push_sync works
+change_listener = None
+push_failures = 0
+push_retry_at = 0
+# Syncs in a row that brought no changes
+idle_syncs = 0
+# The pending sync timeout and when it's due
+sync_timer = 0
+sync_due_at = None
+# Called once the cache is loaded
+waiting_for_load = []
+# Temp file path -> ((size, modification time), content digest)
+temp_digests = {}
+# Disk writes, view reverts and uploads skipped as the content was the same
+avoided = {'writes': 0, 'reverts': 0, 'uploads': 0}
+notes = NoteStore()
+note_cursor = None
 package_path = path.join(sublime.packages_path(), "QuickSimplenote")
 temp_path = path.join(package_path, "temp")
+note_cache = NoteCache(path.join(package_path, 'note_cache'))
+timings = Metrics()
+search_index = SearchIndex()
+settings = sublime.load_settings('quick_simplenote.sublime-settings')
+extension_map = None
+extension_rules = []
+# Title -> (filename base, extension)
+filename_parts = {}
+load_extension_rules()
+note_contents = ContentStore(path.join(package_path, 'contents'),
+    (settings.get('content_cache_size') or 2048) * 1024)
 
-notes = load_notes()
-note_files = [note['filename'] for note in notes]
 if not path.exists(temp_path):
     makedirs(temp_path)
-for f in listdir(temp_path):
-    if f not in note_files:
-        remove(path.join(temp_path, f))
+loader = Thread(target=load_cache)
+loader.daemon = True
+loader.start()
 
-settings = sublime.load_settings('quick_simplenote.sublime-settings')
 settings.clear_on_change('username')
 settings.clear_on_change('password')
 settings.add_on_change('username', reload_if_needed)
 settings.add_on_change('password', reload_if_needed)
+settings.clear_on_change('title_extension_map')
+settings.add_on_change('title_extension_map', update_extension_rules)
 
 reload_if_needed()
@@ -0,0 +1,226 @@
+import re
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import heapq
+from array import array
+from bisect import bisect_left
+from math import log
+
+from simplenote import replace_file
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text):
+    if isinstance(text, bytes):
+        text = text.decode('utf-8', 'replace')
+    return WORD.findall(text.lower())
+
+
+class SearchIndex(object):
+    """ Inverted index over note contents and tags.
+
+        Each note is indexed under the version it was synced at, so a saved
+        index only needs the notes that changed since to be reindexed.
+        Postings are arrays of note ids and weights packed together, sorted
+        by id, as a dict per word costs several times more than the notes.
+        Queries match notes having every word, the last one as a prefix
+        (so results follow what is being typed), ranked by tf-idf with
+        words in the title and tags weighing more.
+    """
+
+    FORMAT = 2
+    TITLE_WEIGHT = 3
+    TAG_WEIGHT = 5
+    MAX_WEIGHT = 255
+    # Words only starting with the typed prefix rank below exact ones
+    PREFIX_WEIGHT = 0.5
+    # Most words a prefix is expanded to
+    MAX_EXPANSIONS = 50
+    # Ids are packed above the weight's 8 bits in 32 bit entries
+    MAX_ID = 1 << 24
+
+    def __init__(self):
+        # term -> array of (note id << 8 | weight), sorted
+        self.postings = {}
+        # note key -> (indexed version, note id, terms)
+        self.documents = {}
+        # note id -> note key, None once reindexed or removed
+        self.note_keys = []
+        # Each distinct term once, shared by the postings and the documents
+        self.terms = {}
+        self.dirty = False
+        self._sorted_terms = None
+
+    def weigh(self, note, content):
+        weights = {}
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'replace')
+        title_end = content.find('\n')
+        if title_end < 0:
+            title_end = len(content)
+        for term in tokenize(content[:title_end]):
+            weights[term] = weights.get(term, 0) + self.TITLE_WEIGHT
+        for term in tokenize(content[title_end:]):
+            weights[term] = weights.get(term, 0) + 1
+        for tag in note.get('tags') or []:
+            for term in tokenize(tag):
+                weights[term] = weights.get(term, 0) + self.TAG_WEIGHT
+        return weights
+
+    def update(self, note, content=None):
+        key = note['key']
+        self.remove([key])
+        if content is None:
+            content = note.get('content')
+        weights = self.weigh(note, content or '')
+        # Reindexing leaves the old id behind, drop them once they are
+        # most of the list so it (and the saved index) stays bounded
+        dead_ids = len(self.note_keys) - len(self.documents)
+        if dead_ids > len(self.documents) or len(self.note_keys) >= self.MAX_ID:
+            self.renumber()
+        # Ids only grow, so appending keeps the postings sorted
+        note_id = len(self.note_keys)
+        self.note_keys.append(key)
+        terms = []
+        for term, weight in weights.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = array('I')
+                self.terms[term] = term
+                self._sorted_terms = None
+            postings.append(note_id << 8 | min(weight, self.MAX_WEIGHT))
+            terms.append(self.terms[term])
+        self.documents[key] = (note.get('synced_version'), note_id, tuple(terms))
+        self.dirty = True
+
+    def remove(self, keys):
+        for key in keys:
+            document = self.documents.pop(key, None)
+            if document is None:
+                continue
+            note_id = document[1]
+            self.note_keys[note_id] = None
+            for term in document[2]:
+                postings = self.postings[term]
+                index = bisect_left(postings, note_id << 8)
+                del postings[index]
+                if not postings:
+                    del self.postings[term]
+                    del self.terms[term]
+                    self._sorted_terms = None
+            self.dirty = True
+
+    def renumber(self):
+        # Gives the indexed notes consecutive ids again
+        new_ids = {}
+        note_keys = []
+        for note_id, key in enumerate(self.note_keys):
+            if key is not None:
+                new_ids[note_id] = len(note_keys)
+                note_keys.append(key)
+        for term, postings in self.postings.items():
+            self.postings[term] = array('I', [new_ids[entry >> 8] << 8 | entry & 0xff for entry in postings])
+        for key, (version, note_id, terms) in self.documents.items():
+            self.documents[key] = (version, new_ids[note_id], terms)
+        self.note_keys = note_keys
+
+    def is_current(self, note):
+        document = self.documents.get(note['key'])
+        return document is not None and document[0] is not None and document[0] == note.get('synced_version')
+
+    def sync(self, notes, get_content):
+        """ Reindexes the notes that changed since the index was saved
+            and drops the ones that are gone
+        """
+        keys = set()
+        for note in notes:
+            keys.add(note['key'])
+            if not self.is_current(note):
+                self.update(note, get_content(note))
+        self.remove([key for key in list(self.documents.keys()) if not key in keys])
+
+    def expand(self, prefix):
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self.postings)
+        terms = []
+        index = bisect_left(self._sorted_terms, prefix)
+        while index < len(self._sorted_terms) and len(terms) < self.MAX_EXPANSIONS:
+            term = self._sorted_terms[index]
+            if not term.startswith(prefix):
+                break
+            terms.append(term)
+            index += 1
+        return terms
+
+    def search(self, query, limit=50):
+        """ Returns the keys of the best matching notes, best first """
+        terms = tokenize(query)
+        if not terms:
+            return []
+        document_count = float(len(self.documents))
+        scores = None
+        for position, term in enumerate(terms):
+            if position == len(terms) - 1:
+                matches = self.expand(term)
+            elif term in self.postings:
+                matches = [term]
+            else:
+                return []
+            term_scores = {}
+            for match in matches:
+                postings = self.postings[match]
+                idf = log(1 + document_count / len(postings))
+                if match != term:
+                    idf *= self.PREFIX_WEIGHT
+                for entry in postings:
+                    note_id = entry >> 8
+                    score = (entry & 0xff) * idf
+                    if score > term_scores.get(note_id, 0):
+                        term_scores[note_id] = score
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = dict((note_id, score + term_scores[note_id]) for note_id, score in scores.items() if note_id in term_scores)
+            if not scores:
+                return []
+        ranked = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        return [self.note_keys[note_id] for note_id, score in ranked]
+
+    def save(self, filepath):
+        temp_filepath = filepath + '.tmp'
+        postings = dict((term, to_bytes(values)) for term, values in self.postings.items())
+        with open(temp_filepath, 'wb') as index_file:
+            pickle.dump((self.FORMAT, postings, self.documents, self.note_keys), index_file, pickle.HIGHEST_PROTOCOL)
+        replace_file(temp_filepath, filepath)
+        self.dirty = False
+
+    @classmethod
+    def load(cls, filepath):
+        index = cls()
+        try:
+            with open(filepath, 'rb') as index_file:
+                saved = pickle.load(index_file)
+            if saved[0] == cls.FORMAT:
+                saved_format, postings, index.documents, index.note_keys = saved
+                index.postings = dict((term, from_bytes(data)) for term, data in postings.items())
+                index.terms = dict((term, term) for term in index.postings)
+        except Exception:
+            # Missing, unreadable or from another version, it gets rebuilt
+            index = cls()
+        return index
+
+
+def to_bytes(values):
+    if hasattr(values, 'tobytes'):
+        return values.tobytes()
+    return values.tostring()
+
+def from_bytes(data):
+    values = array('I')
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    return values
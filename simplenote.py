@@ -14,17 +14,31 @@ if sys.version_info > (3, 0):
     import urllib.error
     from urllib.error import HTTPError
     import urllib.parse as urllib
+    import http.client as httplib
     import html
 else:
     import urllib2
     from urllib2 import HTTPError
     import urllib
+    import httplib
     from HTMLParser import HTMLParser
 
+import os
+import re
 import base64
+import codecs
 import time
 import datetime
 import uuid
+import functools
+import socket
+import random
+import zlib
+import errno
+import email.utils
+from io import BytesIO
+from bisect import bisect_left
+from threading import Lock, Condition
 
 try:
     import json
@@ -44,6 +58,25 @@ BUCKET   = 'note'
 AUTH_URL = 'https://auth.simperium.com/1/%s/authorize/' % (APP_ID)
 DATA_URL = 'https://api.simperium.com/1/%s/%s' % (APP_ID, BUCKET)
 NOTE_FETCH_LENGTH = 1000
+# Bytes read at a time from an index page while decoding its notes
+INDEX_CHUNK_SIZE = 64 * 1024
+# Sent with every request, None to ask for uncompressed responses
+ACCEPT_ENCODING = 'gzip, deflate'
+CONNECTION_POOL_SIZE = 8
+# In seconds, the connect one includes the TLS handshake
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+# Longest a long poll of the changes feed is expected to be held, in seconds
+LONG_POLL_TIMEOUT = 90
+# Requests in flight start at CONCURRENCY_START and adapt up to the maximum
+CONCURRENCY_START = 3
+CONCURRENCY_MAX = 8
+# Retries of a throttled (429), failed (5xx) or dropped request
+MAX_RETRIES = 3
+# Timed out requests already waited read_timeout, they are retried less
+MAX_TIMEOUT_RETRIES = 1
+RETRY_BACKOFF = 0.5
+RETRY_BACKOFF_MAX = 30
 
 class SimplenoteLoginFailed(Exception):
     pass
@@ -52,13 +85,86 @@ class SimplenoteLoginFailed(Exception):
 class Simplenote(object):
     """ Class for interacting with the simplenote web service """
 
-    def __init__(self, username, password):
-        """ object constructor """
+    def __init__(self, username, password, pool_size=CONNECTION_POOL_SIZE, ssl_context=None, max_concurrency=CONCURRENCY_MAX,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, token_path=None):
+        """ object constructor
+
+        With a `token_path` the auth token is kept in that file along with
+        the username, so it's reused instead of logging in again.
+        """
         self.username = username
         self.password = password
+        self.token_path = token_path
+        self.pool = ConnectionPool(pool_size, ssl_context, connect_timeout, read_timeout)
+        # Shared by every call, so all threads back off together
+        self.limiter = AdaptiveLimiter(min(CONCURRENCY_START, max_concurrency), max_concurrency)
+        # Long polls wait on their own connection and don't hold up other requests
+        self.long_poll_pool = ConnectionPool(min(pool_size, 1), ssl_context, connect_timeout, LONG_POLL_TIMEOUT)
+        self.long_poll_limiter = AdaptiveLimiter(1, 1)
+        # Requests by endpoint
+        self.metrics = Metrics()
         self.header = 'X-Simperium-Token'
         self.token = None
+        # So threads starting together log in only once
+        self.token_lock = Lock()
         self.mark = "mark"
+        # Change cursor (Simperium `cv`) of the last index or changes fetched
+        self.current = None
+
+    def urlopen(self, request, endpoint, long_poll=False):
+        """ Method to open a request, recording its metrics under `endpoint`
+
+        The request waits for a slot in the concurrency limiter, which is
+        held until the body has been read. Long polls (`long_poll`) go
+        one at a time on a connection of their own instead. Throttled (429),
+        failed (5xx) or dropped requests are retried up to MAX_RETRIES times
+        with jittered exponential backoff, honoring Retry-After, and timed out
+        ones up to MAX_TIMEOUT_RETRIES times. A request whose token was
+        rejected (401) is retried once with a new one.
+
+        """
+        bytes_out = len(request.data or b'')
+        if ACCEPT_ENCODING and not request.has_header('Accept-encoding'):
+            request.add_header('Accept-Encoding', ACCEPT_ENCODING)
+        token_header = self.header.capitalize()
+        renewed_token = False
+        pool, limiter = self.pool, self.limiter
+        if long_poll:
+            pool, limiter = self.long_poll_pool, self.long_poll_limiter
+        attempt = 0
+        timeouts = 0
+        while True:
+            limiter.acquire()
+            started = time.time()
+            try:
+                response = pool.urlopen(request)
+            except Exception as e:
+                elapsed = time.time() - started
+                retry_after = None
+                retriable = True
+                if isinstance(e, HTTPError):
+                    retriable = e.code == 429 or e.code >= 500
+                    retry_after = parse_retry_after(e.info().get('Retry-After'))
+                elif is_timeout(e):
+                    timeouts += 1
+                    retriable = timeouts <= MAX_TIMEOUT_RETRIES
+                limiter.release(elapsed, throttled=retriable, retry_after=retry_after)
+                retrying = retriable and attempt < MAX_RETRIES
+                self.metrics.record(endpoint, elapsed, bytes_out=bytes_out, errors=1, retries=int(retrying))
+                if not retrying:
+                    if isinstance(e, HTTPError) and e.code == 401 and not renewed_token and request.has_header(token_header):
+                        renewed_token = True
+                        request.add_header(self.header, self.renew_token(request.get_header(token_header)))
+                        continue
+                    raise
+                attempt += 1
+                time.sleep(backoff_delay(attempt, retry_after))
+                continue
+            release = functools.partial(limiter.release, time.time() - started)
+            encoding = (response.info().get('Content-Encoding') or '').strip().lower()
+            if encoding in ('gzip', 'deflate'):
+                response = DecompressingResponse(response, encoding)
+            return MeteredResponse(response, self.metrics, endpoint, started, bytes_out, release)
 
     def authenticate(self, user, password):
         """ Method to get simplenote auth token
@@ -79,7 +185,11 @@ class Simplenote(object):
         else:
             request.data = json.dumps({'username': user, 'password': password}).encode()
         try:
-            res = urllib2.urlopen(request).read()
+            response = self.urlopen(request, 'auth')
+            try:
+                res = response.read()
+            finally:
+                response.close()
             token = json.loads(res.decode('utf-8'))["access_token"]
         except HTTPError:
             raise SimplenoteLoginFailed('Login to Simplenote API failed!')
@@ -91,18 +201,74 @@ class Simplenote(object):
         """ Method to retrieve an auth token.
 
         The cached global token is looked up and returned if it exists. If it
-        is `None` a new one is requested and returned.
+        is `None` the saved one is used, or a new one is requested, saved
+        and returned.
 
         Returns:
             Simplenote API token as string
 
         """
-        if self.token == None:
-            self.token = self.authenticate(self.username, self.password)
+        with self.token_lock:
+            if self.token == None:
+                self.token = self.load_token()
+            if self.token == None:
+                self.token = self.authenticate(self.username, self.password)
+                self.save_token()
+            token = self.token
         try:
-            return str(self.token,'utf-8')
+            return str(token,'utf-8')
         except TypeError:
-            return self.token
+            return token
+
+    def renew_token(self, rejected_token):
+        """ Method to replace a token the server rejected
+
+        Other requests may have been rejected with it too, only the first
+        one to get here logs in again.
+
+        Returns:
+            Simplenote API token as string
+
+        """
+        with self.token_lock:
+            if self.token == rejected_token:
+                self.token = self.authenticate(self.username, self.password)
+                self.save_token()
+        return self.get_token()
+
+    def load_token(self):
+        if not self.token_path:
+            return None
+        try:
+            with open(self.token_path, 'rb') as token_file:
+                saved = json.loads(token_file.read().decode('utf-8'))
+        except (IOError, ValueError):
+            return None
+        # It's only good for the account it was given to
+        if saved.get('username') != self.username:
+            return None
+        return saved.get('token')
+
+    def save_token(self):
+        if not self.token_path:
+            return
+        try:
+            if self.token == None:
+                if os.path.exists(self.token_path):
+                    os.remove(self.token_path)
+                return
+            data = json.dumps({'username': self.username, 'token': self.token}).encode('utf-8')
+            # Only readable by the user, like the settings holding the password
+            temp_path = self.token_path + '.tmp'
+            token_file = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                os.write(token_file, data)
+            finally:
+                os.close(token_file)
+            replace_file(temp_path, self.token_path)
+        except (IOError, OSError):
+            # Logging in again next time is fine
+            pass
 
     def get_note(self, noteid, version=None):
         """ Method to get a specific note
@@ -114,7 +280,7 @@ class Simplenote(object):
         Returns:
             A tuple `(note, status)`
 
-            - note (dict): note object
+            - note (Note): note object
             - status (int): 0 on sucesss and -1 otherwise
 
         """
@@ -127,13 +293,17 @@ class Simplenote(object):
         request = Request(DATA_URL+params)
         request.add_header(self.header, self.get_token())
         try:
-            response = urllib2.urlopen(request)
+            response = self.urlopen(request, 'get_note')
+            try:
+                body = response.read()
+            finally:
+                response.close()
         except HTTPError as e:
             return e, -1
         except IOError as e:
             return e, -1
-        note = json.loads(response.read().decode('utf-8'))
-        note = self.__add_simplenote_api_fields(note, noteid, int(response.info().get("X-Simperium-Version")))
+        note = Note.from_wire(noteid, int(response.info().get("X-Simperium-Version")),
+                              json.loads(body.decode('utf-8')))
         # Sort tags
         # For early versions of notes, tags not always available
         if "tags" in note:
@@ -146,19 +316,19 @@ class Simplenote(object):
         have a "key" field, a new note is created
 
         Arguments
-            - note (dict): note object to update
+            - note (Note or dict): note object to update
 
         Returns:
             A tuple `(note, status)`
-            - note (dict): note object
+            - note (Note): note object
             - status (int): 0 on sucesss and -1 otherwise
 
         """
+        if not isinstance(note, Note):
+            note = Note(note)
         # determine whether to create a new note or update an existing one
-        # Also need to add/remove key field to keep simplenote.py consistency
         if "key" in note:
-            # Then already have a noteid we need to remove before passing to Simperium API
-            noteid = note.pop("key", None)
+            noteid = note.key
             # set modification timestamp if not set by client
             if 'modificationDate' not in note:
                 note["modificationDate"] = time.time()
@@ -169,25 +339,35 @@ class Simplenote(object):
 
         # TODO: Set a ccid?
         # ccid = uuid.uuid4().hex
-        if "version" in note:
-            version = note.pop("version", None)
+        version = note.get("version")
+        if version is not None:
             url = '%s/i/%s/v/%s?response=1' % (DATA_URL, noteid, version)
         else:
             url = '%s/i/%s?response=1' % (DATA_URL, noteid)
 
         # TODO: Could do with being consistent here. Everywhere else is Request(DATA_URL+params)
-        note = self.__remove_simplenote_api_fields(note)
-        request = Request(url, data=json.dumps(note).encode('utf-8'))
+        request = Request(url, data=json.dumps(note.to_wire()).encode('utf-8'))
         request.add_header(self.header, self.get_token())
         request.add_header('Content-Type', 'application/json')
 
         response = ""
         try:
-            response = urllib2.urlopen(request)
+            response = self.urlopen(request, 'update_note')
+            try:
+                body = response.read()
+            finally:
+                response.close()
+        except HTTPError as e:
+            if e.code != 412 or version is None:
+                return e, -1
+            # Precondition failed: the note already has this content,
+            # nothing was changed or transferred back. Its version may be
+            # newer than the one we sent, so it's asked for
+            return self.get_note(noteid)
         except IOError as e:
             return e, -1
-        note = json.loads(response.read().decode('utf-8'))
-        note = self.__add_simplenote_api_fields(note, noteid, int(response.info().get("X-Simperium-Version")))
+        note = Note.from_wire(noteid, int(response.info().get("X-Simperium-Version")),
+                              json.loads(body.decode('utf-8')))
         return note, 0
 
     def add_note(self, note):
@@ -204,14 +384,14 @@ class Simplenote(object):
         Returns:
             A tuple `(note, status)`
 
-            - note (dict): the newly created note
+            - note (Note): the newly created note
             - status (int): 0 on sucesss and -1 otherwise
 
         """
 
         if type(note) == str:
             return self.update_note({"content": note})
-        elif (type(note) == dict) and "content" in note:
+        elif isinstance(note, (dict, Note)) and "content" in note:
             return self.update_note(note)
         else:
             return "No string or valid note.", -1
@@ -235,56 +415,150 @@ class Simplenote(object):
             - status (int): 0 on sucesss and -1 otherwise
 
         """
-        # initialize data
-        status = 0
-        ret = []
-        response_notes = {}
-        notes = { "index" : [] }
+        note_list = []
+        for page, status in self.get_note_pages():
+            if status != 0:
+                return page, status
+            note_list.extend(page)
+        # Can only filter for tags at end, once all notes have been retrieved.
+        if (len(tags) > 0):
+            note_list = [n for n in note_list if (len(set(n["tags"]).intersection(tags)) > 0)]
+        return note_list, 0
+
+    def get_note_pages(self):
+        """ Generator over the pages of the note list
+
+        Each page is requested once the previous one was consumed, so its
+        notes can be worked on while later pages are still to come.
+        `current` is updated once the last page was received.
+
+        Yields:
+            Tuples `(notes, status)`
+
+            - notes (list): The note objects of a page (up to
+            NOTE_FETCH_LENGTH), or the error once a page failed, which
+            is the last one yielded.
+            - status (int): 0 on sucesss and -1 otherwise
 
-        # get the note index
+        """
         # TODO: Using data=false is actually fine with simplenote.vim - sadly no faster though
         params = '/index?limit=%s&data=true' % (str(NOTE_FETCH_LENGTH))
-
-        # perform initial HTTP request
-        request = Request(DATA_URL+params)
-        request.add_header(self.header, self.get_token())
-        try:
-            response = urllib2.urlopen(request)
-            response_notes = json.loads(response.read().decode('utf-8'))
-            # re-write for v1 consistency
-            note_objects = []
-            for n in response_notes["index"]:
-                note_object = self.__add_simplenote_api_fields(n['d'], n['id'], n['v'])
-                note_objects.append(note_object)
-            notes["index"].extend(note_objects)
-        except IOError:
-            status = -1
-
-        # get additional notes if bookmark was set in response
-        while "mark" in response_notes:
-            params += '&mark=%s' % response_notes["mark"]
+        mark = None
+        while True:
+            params_mark = params
+            if mark is not None:
+                params_mark += '&mark=%s' % mark
 
             # perform the actual HTTP request
+            request = Request(DATA_URL+params_mark)
+            request.add_header(self.header, self.get_token())
+            page = []
+            response_notes = {}
+            try:
+                response = self.urlopen(request, 'index')
+                try:
+                    # Notes are decoded one at a time as the body is read,
+                    # so it is never all in memory along with them
+                    for name, value in read_index(response):
+                        if name == "index":
+                            # re-write for v1 consistency
+                            page.append(Note.from_wire(value['id'], value['v'], value['d']))
+                        else:
+                            response_notes[name] = value
+                finally:
+                    response.close()
+            except IOError as e:
+                yield e, -1
+                return
+            mark = response_notes.get("mark")
+            if mark is None:
+                self.current = response_notes.get("current", self.current)
+            yield page, 0
+            if mark is None:
+                return
+
+    def get_changes(self, cv):
+        """ Method to get the notes changed since a change cursor
+
+        Only the changes made after `cv` are fetched, `current` is updated
+        with the cursor of the last change received.
+
+        Arguments:
+            - cv (string): change cursor as returned by a previous call to
+              `get_note_list` or `get_changes`
+
+        Returns:
+            A tuple `(notes, status)`
+
+            - notes (list): A list of changed note objects, notes that were
+            removed come with only `key` and `deleted` set.
+            - status (int): 0 on sucesss, -1 otherwise and -2 if the server
+            rejected the cursor (a full `get_note_list` is needed)
+
+        """
+        changes, cv, status = self.__get_changes(cv)
+        if status == 0:
+            self.current = cv
+        return changes, status
+
+    def wait_for_changes(self, cv):
+        """ Method to wait for the notes changed since a change cursor
+
+        Long polls the changes feed: the server answers as soon as there
+        are changes after `cv`, or with none once it stops waiting.
+        `current` is left alone, the cursor is returned instead.
+
+        Arguments:
+            - cv (string): change cursor to wait for changes after
+
+        Returns:
+            A tuple `(notes, cv, status)`
+
+            - notes (list): like for `get_changes`, empty if nothing changed
+            - cv (string): cursor of the last change received
+            - status (int): like for `get_changes`
+
+        """
+        return self.__get_changes(cv, wait=True)
+
+    def __get_changes(self, cv, wait=False):
+        changed = {}
+        order = []
+        while True:
+            params = '/changes?cv=%s&data=1&limit=%s' % (urllib.quote(str(cv)), str(NOTE_FETCH_LENGTH))
+            if wait:
+                params += '&wait=1'
             request = Request(DATA_URL+params)
             request.add_header(self.header, self.get_token())
             try:
-                response = urllib2.urlopen(request)
-                response_notes = json.loads(response.read().decode('utf-8'))
-                # re-write for v1 consistency
-                note_objects = []
-                for n in response_notes["index"]:
-                    note_object = n['d']
-                    note_object['version'] = n['v']
-                    note_object['key'] = n['id']
-                    note_objects.append(note_object)
-                notes["index"].extend(note_objects)
-            except IOError:
-                status = -1
-        note_list = notes["index"]
-        # Can only filter for tags at end, once all notes have been retrieved.
-        if (len(tags) > 0):
-            note_list = [n for n in note_list if (len(set(n["tags"]).intersection(tags)) > 0)]
-        return note_list, status
+                response = self.urlopen(request, 'changes.wait' if wait else 'changes', long_poll=wait)
+                try:
+                    changes = json.loads(response.read().decode('utf-8'))
+                finally:
+                    response.close()
+            except HTTPError as e:
+                if e.code in (400, 404, 410):
+                    return e, cv, -2
+                return e, cv, -1
+            except IOError as e:
+                return e, cv, -1
+
+            for change in changes:
+                if change.get('o') == '-' or not 'd' in change:
+                    note = Note(key=change['id'], deleted=True)
+                else:
+                    note = Note.from_wire(change['id'], change['ev'], change['d'])
+                if not change['id'] in changed:
+                    order.append(change['id'])
+                changed[change['id']] = note
+                cv = change['cv']
+
+            if len(changes) < NOTE_FETCH_LENGTH:
+                break
+            # The rest is there already
+            wait = False
+
+        return [changed[key] for key in order], cv, 0
 
     def trash_note(self, note_id):
         """ Method to move a note to the trash
@@ -295,7 +569,7 @@ class Simplenote(object):
         Returns:
             A tuple `(note, status)`
 
-            - note (dict): the newly created note or an error message
+            - note (Note): the newly created note or an error message
             - status (int): 0 on sucesss and -1 otherwise
 
         """
@@ -304,15 +578,13 @@ class Simplenote(object):
         if (status == -1):
             return note, status
         # set deleted property, but only if not already trashed
-        # TODO: A 412 is ok, that's unmodified. Should handle this in update_note and
-        # then not worry about checking here
         if not note["deleted"]:
             note["deleted"] = True
             note["modificationDate"] = time.time()
             # update note
             return self.update_note(note)
         else:
-            return 0, note
+            return note, 0
 
     def delete_note(self, note_id):
         """ Method to permanently delete a note
@@ -336,61 +608,168 @@ class Simplenote(object):
         request = Request(url=DATA_URL+params, method='DELETE')
         request.add_header(self.header, self.get_token())
         try:
-            response = urllib2.urlopen(request)
+            response = self.urlopen(request, 'delete_note')
+            try:
+                response.read()
+            finally:
+                response.close()
         except IOError as e:
             return e, -1
         except HTTPError as e:
             return e, -1
         return {}, 0
 
-    def __add_simplenote_api_fields(self, note, noteid, version):
-        # Compatibility with original Simplenote API v2.1.5
-        note[u'key'] = noteid
-        note[u'version'] = version
-        note[u'modifydate'] = note["modificationDate"]
-        note[u'createdate'] = note["creationDate"]
-        note[u'systemtags'] = note["systemTags"]
+class Note(object):
+    """ A note, used like the dicts of the original Simplenote API: fields
+    are read and set by key, and the old names (modifydate, createdate,
+    systemtags) are aliases of the Simperium ones, so each value is stored
+    once. The fields clients keep about a note locally have their own slots
+    and are never sent. Any other field is kept in `extra`. Fields that were
+    never set are missing, like in a dict.
+    """
+
+    WIRE_FIELDS = ('content', 'tags', 'systemTags', 'creationDate', 'modificationDate',
+                   'deleted', 'shareURL', 'publishURL')
+    LOCAL_FIELDS = ('title', 'filename', 'needs_update', 'local_modifydate', 'synced_version', 'content_digest')
+    FIELDS = ('key', 'version') + WIRE_FIELDS + LOCAL_FIELDS
+    FIELD_NAMES = frozenset(FIELDS)
+    ALIASES = {'modifydate': 'modificationDate', 'createdate': 'creationDate', 'systemtags': 'systemTags'}
+    __slots__ = FIELDS + ('extra',)
+
+    def __init__(self, fields=None, **kwargs):
+        self.extra = None
+        if fields:
+            self.update(fields)
+        if kwargs:
+            self.update(kwargs)
+
+    @classmethod
+    def from_wire(cls, noteid, version, data):
+        """ Note from a Simperium object, leaving out local fields older
+        clients sent along """
+        note = cls()
+        for name, value in data.items():
+            if not name in cls.LOCAL_FIELDS:
+                note[name] = value
+        note.key = noteid
+        note.version = version
         return note
 
-    def __remove_simplenote_api_fields(self, note):
-        # These two should have already removed by this point since they are
-        # needed for updating, etc, but _just_ incase...
-        note.pop("key", None)
-        note.pop("version", None)
-        # Let's only set these ones if they exist. We don't want None so we can
-        # still set defaults afterwards
-        mappings = {
-                "modifydate": "modificationDate",
-                "createdate": "creationDate",
-                "systemtags": "systemTags"
-        }
-        if sys.version_info < (3, 0):
-            for k,v in mappings.iteritems():
-                if k in note:
-                    note[v] = note.pop(k)
+    def to_wire(self):
+        """ Simperium object for this note, with defaults for the missing
+        fields """
+        data = {}
+        if self.extra:
+            data.update(self.extra)
+        for name in self.WIRE_FIELDS:
+            if hasattr(self, name):
+                data[name] = getattr(self, name)
+        now = time.time()
+        data.setdefault('content', '')
+        data.setdefault('tags', [])
+        data.setdefault('systemTags', [])
+        data.setdefault('creationDate', now)
+        data.setdefault('modificationDate', now)
+        data.setdefault('deleted', False)
+        data.setdefault('shareURL', '')
+        data.setdefault('publishURL', '')
+        return data
+
+    def __getitem__(self, name):
+        name = self.ALIASES.get(name, name)
+        if name in self.FIELD_NAMES:
+            try:
+                return getattr(self, name)
+            except AttributeError:
+                raise KeyError(name)
+        if self.extra is None:
+            raise KeyError(name)
+        return self.extra[name]
+
+    def __setitem__(self, name, value):
+        name = self.ALIASES.get(name, name)
+        if name in self.FIELD_NAMES:
+            setattr(self, name, value)
         else:
-            for k,v in mappings.items():
-                if k in note:
-                    note[v] = note.pop(k)
-        # Need to add missing dict stuff if missing, might as well do by
-        # default, not just for note objects only containing content
-        createDate = time.time()
-        note_dict = {
-            "tags" : [],
-            "systemTags" : [],
-            "creationDate" : createDate,
-            "modificationDate" : createDate,
-            "deleted" : False,
-            "shareURL" : "",
-            "publishURL" : "",
-        }
-        if sys.version_info < (3, 0):
-            for k,v in note_dict.iteritems():
-                note.setdefault(k, v)
+            if self.extra is None:
+                self.extra = {}
+            self.extra[name] = value
+
+    def __delitem__(self, name):
+        name = self.ALIASES.get(name, name)
+        if name in self.FIELD_NAMES:
+            try:
+                delattr(self, name)
+            except AttributeError:
+                raise KeyError(name)
+        elif self.extra is None:
+            raise KeyError(name)
         else:
-            for k,v in note_dict.items():
-                note.setdefault(k, v)
-        return note
+            del self.extra[name]
+
+    def __contains__(self, name):
+        name = self.ALIASES.get(name, name)
+        if name in self.FIELD_NAMES:
+            return hasattr(self, name)
+        return self.extra is not None and name in self.extra
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __bool__(self):
+        # Any note is a note, `if note:` shouldn't count its fields
+        return True
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return 'Note(%r)' % dict(self.items())
+
+    def get(self, name, default=None):
+        name = self.ALIASES.get(name, name)
+        if name in self.FIELD_NAMES:
+            return getattr(self, name, default)
+        if self.extra is None:
+            return default
+        return self.extra.get(name, default)
+
+    def pop(self, name, *default):
+        try:
+            value = self[name]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[name]
+        return value
+
+    def setdefault(self, name, default=None):
+        if not name in self:
+            self[name] = default
+        return self[name]
+
+    def update(self, fields):
+        for name in fields:
+            self[name] = fields[name]
+
+    def keys(self):
+        keys = [name for name in self.FIELDS if hasattr(self, name)]
+        if self.extra:
+            keys.extend(self.extra.keys())
+        return keys
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def __getstate__(self):
+        return dict(self.items())
+
+    def __setstate__(self, state):
+        self.extra = None
+        self.update(state)
+
 
 class Request(urllib2.Request):
     """ monkey patched version of urllib2's Request to support HTTP DELETE
@@ -410,3 +789,520 @@ class Request(urllib2.Request):
             return urllib2.Request.get_method(self)
     else:
         pass
+
+
+class ConnectionPool(object):
+    """ Keeps idle keep-alive connections per host so consecutive requests,
+        from any thread, don't pay a new TCP and TLS handshake each time.
+
+        Requests are taken as urllib2 `Request` objects and the responses
+        behave like the ones returned by `urlopen`, HTTP errors included.
+        With a size of 0, or when a proxy is configured, requests go through
+        `urlopen` as usual.
+
+        Connections give up after `connect_timeout` seconds to connect and
+        `read_timeout` seconds without receiving anything.
+    """
+
+    def __init__(self, size=CONNECTION_POOL_SIZE, ssl_context=None, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+        self.size = size
+        self.ssl_context = ssl_context
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.connections_opened = 0
+        self.requests = 0
+        self._idle = {}
+        self._lock = Lock()
+
+    def urlopen(self, request):
+        with self._lock:
+            self.requests += 1
+        if self.size <= 0 or urllib2.getproxies():
+            with self._lock:
+                self.connections_opened += 1
+            return urllib2.urlopen(request, timeout=self.read_timeout)
+
+        if sys.version_info < (3, 0):
+            scheme = request.get_type()
+            host = request.get_host()
+            selector = request.get_selector()
+        else:
+            scheme = request.type
+            host = request.host
+            selector = request.selector
+        key = (scheme, host)
+        headers = dict(request.header_items())
+        if request.data is not None and not 'Content-type' in headers:
+            headers['Content-type'] = 'application/x-www-form-urlencoded'
+
+        connection, reused = self._get(key)
+        try:
+            connection.request(request.get_method(), selector, request.data, headers)
+            response = connection.getresponse()
+        except (httplib.HTTPException, socket.error) as e:
+            connection.close()
+            if not reused or not is_stale_connection(e):
+                raise
+            # Stale keep-alive connection closed by the server, try a new one
+            connection, reused = self._get(key, fresh=True)
+            try:
+                connection.request(request.get_method(), selector, request.data, headers)
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                raise
+
+        pooled_response = PooledResponse(self, key, connection, response)
+        if response.status >= 400:
+            body = pooled_response.read()
+            raise HTTPError(request.get_full_url(), response.status, response.reason,
+                            response.msg, BytesIO(body))
+        return pooled_response
+
+    def release(self, key, connection, reusable):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if reusable and len(idle) < self.size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _get(self, key, fresh=False):
+        if not fresh:
+            with self._lock:
+                idle = self._idle.get(key)
+                if idle:
+                    return idle.pop(), True
+        scheme, host = key
+        with self._lock:
+            self.connections_opened += 1
+        if scheme == 'https':
+            if self.ssl_context is not None:
+                connection = httplib.HTTPSConnection(host, timeout=self.connect_timeout, context=self.ssl_context)
+            else:
+                connection = httplib.HTTPSConnection(host, timeout=self.connect_timeout)
+        else:
+            connection = httplib.HTTPConnection(host, timeout=self.connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+        return connection, False
+
+
+class PooledResponse(object):
+    """ Response of a pooled request, gives the connection back to the pool
+        once the body has been read
+    """
+
+    def __init__(self, pool, key, connection, response):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.code = response.status
+        self.msg = response.reason
+
+    def read(self, amt=None):
+        if self.connection is None:
+            return b''
+        if amt is None:
+            data = self.response.read()
+        else:
+            data = self.response.read(amt)
+        if amt is None or not data:
+            self.close()
+        return data
+
+    def close(self):
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        reusable = self.response.isclosed() and not self.response.will_close
+        if not reusable:
+            self.response.close()
+        self.pool.release(self.key, connection, reusable)
+
+    def info(self):
+        return self.response.msg
+
+    def getcode(self):
+        return self.code
+
+
+def is_stale_connection(error):
+    """ Whether a request on a reused connection failed as the server had
+        closed it: dropped before any response, never a timeout
+    """
+    if isinstance(error, httplib.BadStatusLine):
+        # Including RemoteDisconnected on Python 3
+        return True
+    return isinstance(error, socket.error) and not is_timeout(error) and \
+        getattr(error, 'errno', None) in (errno.ECONNRESET, errno.EPIPE)
+
+def is_timeout(error):
+    """ Whether a request failed for taking longer than its timeout """
+    if isinstance(error, urllib2.URLError):
+        error = error.reason
+    # Python 2's ssl raises a plain SSLError when reads time out
+    return isinstance(error, socket.timeout) or \
+        (isinstance(error, socket.error) and 'timed out' in str(error))
+
+def parse_retry_after(value):
+    """ Seconds to wait from a Retry-After header (seconds or HTTP date) """
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        parsed = email.utils.parsedate_tz(value)
+        if not parsed:
+            return None
+        seconds = email.utils.mktime_tz(parsed) - time.time()
+    return min(RETRY_BACKOFF_MAX, max(0, seconds))
+
+def backoff_delay(attempt, retry_after=None):
+    """ Full jitter exponential backoff, never shorter than Retry-After """
+    delay = random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** attempt))
+    if retry_after:
+        delay = max(delay, retry_after)
+    return delay
+
+def replace_file(source, target):
+    """ Moves source over target, atomically where the platform can """
+    if hasattr(os, 'replace'):
+        os.replace(source, target)
+        return
+    try:
+        os.rename(source, target)
+    except OSError:
+        # Windows won't rename over an existing file, and Python 2
+        # has no atomic replace there
+        if not os.path.exists(target):
+            raise
+        os.remove(target)
+        os.rename(source, target)
+
+
+class JSONStreamReader(object):
+    """ Decodes the JSON values of a response body one at a time while
+        reading it, keeping only the part not decoded yet in memory
+    """
+
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+    decoder = json.JSONDecoder()
+
+    def __init__(self, response, chunk_size=INDEX_CHUNK_SIZE):
+        self.response = response
+        self.chunk_size = chunk_size
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = u''
+        self.position = 0
+        self.eof = False
+
+    def fill(self, size=0):
+        # Reads more of the body, False once it's all read
+        if self.eof:
+            return False
+        data = self.response.read(max(size, self.chunk_size))
+        self.eof = not data
+        self.buffer = self.buffer[self.position:] + self.text_decoder.decode(data, self.eof)
+        self.position = 0
+        return True
+
+    def peek(self):
+        # Next character that isn't whitespace, None at the end
+        while True:
+            self.position = self.WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.fill():
+                return None
+
+    def expect(self, characters):
+        character = self.peek()
+        if character is None or not character in characters:
+            raise ValueError('Expected one of %r in the JSON body' % characters)
+        self.position += 1
+        return character
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # A number could go on in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            # Read at least as much as is pending, so a value longer than
+            # a chunk isn't decoded over and over
+            self.fill(len(self.buffer) - self.position)
+
+    def finish(self):
+        # Reads what's left, so the connection can be reused
+        while self.fill():
+            pass
+
+
+def read_index(response):
+    """ Generator over the fields of an index page body as (name, value),
+        with the entries of `index` yielded one at a time as ("index", entry)
+    """
+    reader = JSONStreamReader(response)
+    reader.expect('{')
+    if reader.peek() != '}':
+        while True:
+            name = reader.value()
+            reader.expect(':')
+            if name == "index" and reader.peek() == '[':
+                reader.expect('[')
+                if reader.peek() == ']':
+                    reader.expect(']')
+                else:
+                    while True:
+                        yield name, reader.value()
+                        if reader.expect(',]') == ']':
+                            break
+            else:
+                yield name, reader.value()
+            if reader.expect(',}') == '}':
+                break
+    else:
+        reader.expect('}')
+    reader.finish()
+
+
+class AdaptiveLimiter(object):
+    """ Limits the requests in flight, adapting the limit to the server
+        (additive increase, multiplicative decrease):
+
+        - While latency stays close to the best seen, the limit grows by
+          about one every `limit` requests.
+        - When latency climbs, the limit shrinks a little.
+        - On throttling or errors it halves, and a Retry-After holds every
+          new request until it has passed.
+    """
+
+    def __init__(self, initial=CONCURRENCY_START, maximum=CONCURRENCY_MAX, minimum=1):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.limit = float(max(minimum, min(initial, self.maximum)))
+        self.in_flight = 0
+        self.baseline = None
+        self.blocked_until = 0
+        self._condition = Condition()
+
+    def acquire(self):
+        with self._condition:
+            while True:
+                wait = self.blocked_until - time.time()
+                if wait > 0:
+                    self._condition.wait(wait)
+                elif self.in_flight >= int(self.limit):
+                    self._condition.wait()
+                else:
+                    break
+            self.in_flight += 1
+
+    def release(self, latency=None, throttled=False, retry_after=None):
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit / 2)
+                if retry_after:
+                    self.blocked_until = max(self.blocked_until, time.time() + retry_after)
+            elif latency is not None:
+                if self.baseline is None or latency < self.baseline:
+                    self.baseline = latency
+                else:
+                    # Follow slow changes of the link
+                    self.baseline += (latency - self.baseline) * 0.01
+                if latency <= self.baseline * 1.5 + 0.005:
+                    self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+                else:
+                    self.limit = max(self.minimum, self.limit * 0.9)
+            self._condition.notify_all()
+
+
+class DecompressingResponse(object):
+    """ Response with a gzip or deflate body, decompressed as it's read
+
+        Reads with a size return at most that many decompressed bytes, so a
+        large body is never in memory at once. `bytes_read` counts the
+        compressed bytes received.
+    """
+
+    def __init__(self, response, encoding, chunk_size=INDEX_CHUNK_SIZE):
+        self.response = response
+        self.encoding = encoding
+        self.chunk_size = chunk_size
+        if encoding == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            # Picked once the first two bytes arrive
+            self.decompressor = None
+        self.header = b''
+        # Decompressed bytes not returned yet
+        self.tail = b''
+        self.bytes_read = 0
+        self.finished = False
+
+    def start_deflate(self, header):
+        # Some servers send deflate without the zlib header, which is two
+        # bytes for compression method 8 that make a multiple of 31
+        header = bytearray(header[:2])
+        if len(header) == 2 and header[0] & 0x0f == 8 and (header[0] << 8 | header[1]) % 31 == 0:
+            return zlib.decompressobj()
+        return zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def decompress(self, data, amt):
+        if self.decompressor is None:
+            self.header += data
+            if len(self.header) < 2:
+                return b''
+            data, self.header = self.header, b''
+            self.decompressor = self.start_deflate(data)
+        return self.decompressor.decompress(data, amt)
+
+    def finish(self):
+        self.finished = True
+        if self.decompressor is None:
+            # A body shorter than the zlib header
+            self.decompressor = self.start_deflate(self.header)
+            self.tail += self.decompressor.decompress(self.header)
+        self.tail += self.decompressor.flush()
+
+    def read(self, amt=None):
+        if amt is None:
+            chunks = []
+            chunk = self.read(self.chunk_size)
+            while chunk:
+                chunks.append(chunk)
+                chunk = self.read(self.chunk_size)
+            return b''.join(chunks)
+        while not self.tail and not self.finished:
+            data = b''
+            if self.decompressor is not None:
+                data = self.decompressor.unconsumed_tail
+            if not data:
+                data = self.response.read(self.chunk_size)
+                self.bytes_read += len(data)
+                if not data:
+                    self.finish()
+                    break
+            self.tail = self.decompress(data, amt)
+        data, self.tail = self.tail[:amt], self.tail[amt:]
+        return data
+
+    def close(self):
+        self.response.close()
+
+    def info(self):
+        return self.response.info()
+
+    def getcode(self):
+        return self.response.getcode()
+
+
+class MeteredResponse(object):
+    """ Response that records its request once the body has been read
+
+        `bytes_in` is what came over the wire and `bytes_decoded` the body
+        it was decompressed to, if it was.
+    """
+
+    def __init__(self, response, metrics, endpoint, started, bytes_out, on_done=None):
+        self.response = response
+        self.metrics = metrics
+        self.endpoint = endpoint
+        self.started = started
+        self.bytes_out = bytes_out
+        self.on_done = on_done
+        self.bytes_in = 0
+        self.recorded = False
+
+    def read(self, amt=None):
+        try:
+            if amt is None:
+                data = self.response.read()
+            else:
+                data = self.response.read(amt)
+        except Exception:
+            # A timeout or a dropped connection, the request is done too
+            self.record(errors=1)
+            raise
+        self.bytes_in += len(data)
+        if amt is None or not data:
+            self.record()
+        return data
+
+    def record(self, **counters):
+        if not self.recorded:
+            self.recorded = True
+            self.metrics.record(self.endpoint, time.time() - self.started,
+                                bytes_in=getattr(self.response, 'bytes_read', self.bytes_in),
+                                bytes_decoded=self.bytes_in, bytes_out=self.bytes_out, **counters)
+            if self.on_done:
+                self.on_done()
+
+    def close(self):
+        self.record()
+        self.response.close()
+
+    def info(self):
+        return self.response.info()
+
+    def getcode(self):
+        return self.response.getcode()
+
+
+class Metrics(object):
+    """ Thread safe latency histograms and counters by name """
+
+    # Upper bounds of the histogram buckets, in seconds
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = Lock()
+
+    def record(self, name, seconds, **counters):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                entry = {'count': 0, 'total': 0.0, 'max': 0.0,
+                         'histogram': [0] * (len(self.BUCKETS) + 1)}
+                self._entries[name] = entry
+            entry['count'] += 1
+            entry['total'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+            entry['histogram'][bisect_left(self.BUCKETS, seconds)] += 1
+            for counter, value in counters.items():
+                entry[counter] = entry.get(counter, 0) + value
+
+    def snapshot(self):
+        """ Returns the entries as plain dicts, histograms as
+            [upper bound, count] pairs (None for the last, unbounded one)
+        """
+        bounds = list(self.BUCKETS) + [None]
+        snapshot = {}
+        with self._lock:
+            for name, entry in self._entries.items():
+                entry = dict(entry)
+                entry['mean'] = entry['total'] / entry['count']
+                entry['histogram'] = [[bound, count] for bound, count in zip(bounds, entry['histogram']) if count]
+                snapshot[name] = entry
+        return snapshot
+
+    def reset(self):
+        with self._lock:
+            self._entries = {}